@@ -1,4 +1,30 @@
 import csv
+import datetime
+import os
+
+# version of the calculation, to be raised with every change that changes the computed values of the tax forms
+# (cached results of other versions are not reused)
+TOOL_VERSION = '1.1.0'
+
+
+class RateDataError(ValueError):
+    """
+    the exchange rates or the CPI values needed for a statement could not be fetched or are missing from the rate data,
+    a failure of the rate sources rather than of the statement.
+    """
+    pass
+
+
+def get_cache_dir():
+    """
+    directory of the rate data kept between runs (CPI values, FX rates).
+    can be set with the TAX_FORMS_GENERATOR_CACHE_DIR environment variable.
+    """
+    default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'tax_forms_generator')
+    cache_dir = os.environ.get('TAX_FORMS_GENERATOR_CACHE_DIR', default_cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
 
 def get_date_format(datetime_string, date_slash_format='normal'):
     """
@@ -20,52 +46,227 @@ def get_date_format(datetime_string, date_slash_format='normal'):
     return date_format
 
 
-def get_trades_col_names(csv_file):
+def infer_date_slash_format(date_strings):
+    """
+    decide once, from all the dates of the file, whether the dates with slashes are 'normal' (%d/%m/%Y) or 'USA'
+    (%m/%d/%Y): a number above 12 can only be a day. if no date decides, the order in which the dates keep the order
+    of the file is chosen, and 'normal' if both are equally ordered.
+    date_strings can be any iterable, it is consumed in a single pass without keeping the dates.
+    """
+    normal_possible = True
+    usa_possible = True
+    num_ordered_normal = 0
+    num_ordered_usa = 0
+    previous_date = None
+    for datetime_string in date_strings:
+        if ',' not in datetime_string and '-' not in datetime_string and '/' in datetime_string:
+            first, second, year = [int(x) for x in datetime_string.split('/')]
+            normal_possible = normal_possible and second <= 12
+            usa_possible = usa_possible and first <= 12
+            if previous_date is not None:
+                previous_first, previous_second, previous_year = previous_date
+                num_ordered_normal += (previous_year, previous_second, previous_first) <= (year, second, first)
+                num_ordered_usa += (previous_year, previous_first, previous_second) <= (year, first, second)
+            previous_date = (first, second, year)
+
+    if normal_possible and not usa_possible:
+        return 'normal'
+    elif usa_possible and not normal_possible:
+        return 'USA'
+    elif not normal_possible and not usa_possible:
+        raise ValueError('dates with slashes fit neither the normal nor the USA day/month order')
+
+    if num_ordered_usa > num_ordered_normal:
+        return 'USA'
+    else:
+        return 'normal'
+
+
+def get_date_parser(date_slash_format='normal'):
+    """
+    returns a function that parses the datetime strings of the IB csv file (in any of the forms of get_date_format),
+    and caches the result of every distinct string. ISO dates take the fromisoformat fast path.
+    """
+    if date_slash_format not in ['normal', 'USA']:
+        raise ValueError('invalid date_slash_format', date_slash_format)
+    parsed_datetimes = {}
+
+    def parse_date(datetime_string):
+        if datetime_string not in parsed_datetimes:
+            if ',' in datetime_string:
+                parsed_datetimes[datetime_string] = datetime.datetime.fromisoformat(datetime_string.replace(', ', ' '))
+            elif '-' in datetime_string:
+                parsed_datetimes[datetime_string] = datetime.datetime.fromisoformat(datetime_string)
+            else:
+                date_format = get_date_format(datetime_string, date_slash_format=date_slash_format)
+                parsed_datetimes[datetime_string] = datetime.datetime.strptime(datetime_string, date_format)
+        return parsed_datetimes[datetime_string]
+
+    return parse_date
+
+
+# column titles in the Header row of each section of the IB csv file, and the names they are referred to by
+TRADES_HEADER_COL_NAMES = {'DataDiscriminator': 'trade_type',
+                           'Asset Category': 'asset_category',
+                           'Currency': 'currency',
+                           'Symbol': 'ticker',
+                           'Date/Time': 'datetime',
+                           'Quantity': 'quantity',
+                           'T. Price': 'price',
+                           'Comm/Fee': 'fee'}
+DIVIDENDS_HEADER_COL_NAMES = {'Currency': 'currency',
+                              'Date': 'datetime',
+                              'Description': 'ticker',
+                              'Amount': 'amount'}
+SECTIONS_HEADER_COL_NAMES = {'Trades': TRADES_HEADER_COL_NAMES,
+                             'Dividends': DIVIDENDS_HEADER_COL_NAMES,
+                             'Withholding Tax': DIVIDENDS_HEADER_COL_NAMES}
+
+# the asset categories of the Trades section that are reported in form 1325
+TRADES_ASSET_CATEGORIES = ['Stocks', 'Equity and Index Options']
+
+
+def get_col_names_from_header(header_row, header_col_names):
+    col_names = {}
+    col_names['main'] = 0
+    col_names['header'] = 1
+    for col_index, element in enumerate(header_row):
+        if element in header_col_names:
+            col_names[header_col_names[element]] = col_index
+    return col_names
+
+
+def get_section_col_names(csv_file, section_names, header_col_names):
     col_names = {}
     with open(csv_file, 'r') as read_obj:
         csv_reader = csv.reader(read_obj)
         for row in csv_reader:
-            if row[0] == 'Trades' and row[1] == 'Header':
-                col_names['main'] = 0
-                col_names['header'] = 1
-                for col_index, element in enumerate(row):
-                    if element == 'DataDiscriminator':
-                        col_names['trade_type'] = col_index
-                    if element == 'Asset Category':
-                        col_names['asset_category'] = col_index
-                    if element == 'Currency':
-                        col_names['currency'] = col_index
-                    if element == 'Symbol':
-                        col_names['ticker'] = col_index
-                    if element == 'Date/Time':
-                        col_names['datetime'] = col_index
-                    if element == 'Quantity':
-                        col_names['quantity'] = col_index
-                    if element == 'T. Price':
-                        col_names['price'] = col_index
-                    if element == 'Comm/Fee':
-                        col_names['fee'] = col_index
+            if row[0] in section_names and row[1] == 'Header':
+                col_names = get_col_names_from_header(row, header_col_names)
                 break
     return col_names
 
 
+def get_trades_col_names(csv_file):
+    return get_section_col_names(csv_file, ['Trades'], TRADES_HEADER_COL_NAMES)
+
+
 def get_dividends_col_names(csv_file):
-    col_names = {}
+    return get_section_col_names(csv_file, ['Dividends', 'Withholding Tax'], DIVIDENDS_HEADER_COL_NAMES)
+
+
+def iter_statement_rows(csv_file, section_names, verbosity=0, stats=None, sections_col_names=None):
+    """
+    iterate over the Data rows of the given sections of the IB csv file as (section name, row, col_names), reading the
+    file once from top to bottom. the column names of a section are resolved as soon as its Header row appears, and
+    are also kept in sections_col_names if given.
+    the number of rows read is added to stats (see run_stats.RunStats) if given, once the file is read to the end.
+    """
+    if sections_col_names is None:
+        sections_col_names = {}
+    num_rows = 0
     with open(csv_file, 'r') as read_obj:
         csv_reader = csv.reader(read_obj)
         for row in csv_reader:
-            if row[0] in ['Dividends', 'Withholding Tax'] and row[1] == 'Header':
-                col_names['main'] = 0
-                col_names['header'] = 1
-                for col_index, element in enumerate(row):
-                    if element == 'Currency':
-                        col_names['currency'] = col_index
-                    if element == 'Date':
-                        col_names['datetime'] = col_index
-                    if element == 'Description':
-                        col_names['ticker'] = col_index
-                    if element == 'Amount':
-                        col_names['amount'] = col_index
-                break
-    return col_names
+            num_rows += 1
+            if verbosity == 1:
+                print(row)
+            if len(row) < 2 or row[0] not in section_names:
+                continue
+            if row[1] == 'Header':
+                sections_col_names[row[0]] = get_col_names_from_header(row, SECTIONS_HEADER_COL_NAMES[row[0]])
+            elif row[1] == 'Data' and row[0] in sections_col_names:
+                yield row[0], row, sections_col_names[row[0]]
+    if stats is not None:
+        stats.count('rows_read', num_rows)
+    return
+
+
+def read_statement_sections(csv_file, section_handlers, verbosity=0, stats=None):
+    """
+    read the IB csv file once, from top to bottom. the column names of a section are resolved as soon as its Header
+    row appears, and every Data row is passed on to the handler of its section, as handler(row, col_names).
+    the number of rows read is added to stats (see run_stats.RunStats) if given.
+    returns the column names of the sections that were found in the file.
+    """
+    sections_col_names = {}
+    for section_name, row, col_names in iter_statement_rows(csv_file, section_handlers, verbosity=verbosity,
+                                                            stats=stats, sections_col_names=sections_col_names):
+        section_handlers[section_name](row, col_names)
+    return sections_col_names
+
+
+def validate_statement(csv_file):
+    """
+    check the structure of the IB csv file without computing anything (no network and no Excel): the sections found
+    with their number of Data rows, the columns missing in the Header rows of the sections that are used (by section
+    and row number, a section can have several Header rows), the number of closed lots and dividends, the inferred
+    order of the dates with slashes, the currencies, the CPI months of the closed lots and the last date of the closed
+    lots and dividends (the last date the FX rates are needed for).
+    """
+    report = {'csv_file': csv_file, 'sections': {}, 'missing_columns': {}, 'closed_lots': 0, 'dividends': 0,
+              'withholding_tax': 0}
+    sections_col_names = {}
+    currencies = set()
+    dividend_date_strings = []
+    closed_lot_date_strings = []
+    previous_trade_datetime = None
+    with open(csv_file, 'r') as read_obj:
+        csv_reader = csv.reader(read_obj)
+        for num_row, row in enumerate(csv_reader, start=1):
+            if len(row) < 2:
+                continue
+            section_name = row[0]
+            report['sections'].setdefault(section_name, 0)
+            if row[1] == 'Header' and section_name in SECTIONS_HEADER_COL_NAMES:
+                header_col_names = SECTIONS_HEADER_COL_NAMES[section_name]
+                sections_col_names[section_name] = get_col_names_from_header(row, header_col_names)
+                missing_columns = [title for title in header_col_names if title not in row]
+                if len(missing_columns) > 0:
+                    report['missing_columns'][section_name + ', row ' + str(num_row)] = missing_columns
+            if row[1] != 'Data':
+                continue
+            report['sections'][section_name] += 1
+            if section_name not in sections_col_names:
+                continue
+            col_names = sections_col_names[section_name]
+            required_col_names = ['currency', 'datetime']
+            if section_name == 'Trades':
+                required_col_names += ['asset_category', 'trade_type']
+            if any(col_name not in col_names for col_name in required_col_names):
+                continue
+
+            # the same rows as the section handlers of tax_forms_functions
+            if section_name == 'Trades' and row[col_names['asset_category']] in TRADES_ASSET_CATEGORIES:
+                trade_type = row[col_names['trade_type']]
+                if 'Trade' in trade_type:
+                    previous_trade_datetime = row[col_names['datetime']]
+                elif 'ClosedLot' in trade_type and previous_trade_datetime is not None:
+                    report['closed_lots'] += 1
+                    currencies.add(row[col_names['currency']])
+                    closed_lot_date_strings += [row[col_names['datetime']], previous_trade_datetime]
+            elif section_name in ['Dividends', 'Withholding Tax'] and 'Total' not in row[col_names['currency']]:
+                if section_name == 'Dividends':
+                    report['dividends'] += 1
+                else:
+                    report['withholding_tax'] += 1
+                currencies.add(row[col_names['currency']])
+                dividend_date_strings += [row[col_names['datetime']]]
 
+    report['date_slash_format'] = None
+    report['cpi_months'] = []
+    report['last_date'] = None
+    try:
+        report['date_slash_format'] = infer_date_slash_format(dividend_date_strings + closed_lot_date_strings)
+        parse_date = get_date_parser(report['date_slash_format'])
+        closed_lot_datetimes = [parse_date(date_string) for date_string in closed_lot_date_strings]
+        # the index months of the open and close dates (as cpi_israel.get_cpi_month_key), i.e. the CPI values needed
+        report['cpi_months'] = sorted(set('%04d-%02d' % (date_input.year, date_input.month)
+                                          for date_input in closed_lot_datetimes))
+        datetimes = closed_lot_datetimes + [parse_date(date_string) for date_string in dividend_date_strings]
+        if len(datetimes) > 0:
+            report['last_date'] = max(datetimes).date().isoformat()
+    except ValueError as error:
+        report['date_error'] = str(error.args[0])
+    report['currencies'] = sorted(currencies)
+    return report
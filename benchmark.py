@@ -0,0 +1,121 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+from cpi_israel import IsraelCpiStore, get_cpi_fixture_fetcher
+from synthetic_statement import write_synthetic_statement, write_fx_fixture, write_cpi_fixture
+
+BENCHMARK_SIZES = {'small': {'num_stock_trades': 100, 'num_option_trades': 20, 'num_dividends': 50},
+                   'medium': {'num_stock_trades': 2000, 'num_option_trades': 400, 'num_dividends': 1000},
+                   'large': {'num_stock_trades': 20000, 'num_option_trades': 4000, 'num_dividends': 10000}}
+
+
+def get_version_label():
+    """
+    the git commit of the code being measured, so results of different versions can be told apart.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def get_timing_summary(timings):
+    return {'min': min(timings), 'median': statistics.median(timings), 'max': max(timings), 'runs': timings}
+
+
+def run_benchmark(size='medium', num_repeats=3, engine='scalar', currencies=('USD',), date_format='mixed',
+                  years=(2023,), seed=0, work_dir=None):
+    """
+    time extract_trades_data_from_csv, extract_dividends_data_from_csv and write_tax_form_files separately on a
+    synthetic statement, with the FX rates and the CPI values served from local fixtures (no network access).
+    every repeat starts from an empty CPI cache. returns the results as a dict.
+    """
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='tax_forms_benchmark_')
+    # the default ECB rate store is loaded from the cache dir, so it must point to the fixture before first use
+    os.environ['TAX_FORMS_GENERATOR_CACHE_DIR'] = work_dir
+    import tax_forms_functions
+
+    statement_config = dict(BENCHMARK_SIZES[size], currencies=list(currencies), date_format=date_format,
+                            years=list(years), seed=seed)
+    csv_file_name = 'synthetic_' + size
+    counts = write_synthetic_statement(work_dir + '/' + csv_file_name + '.csv', **statement_config)
+    write_fx_fixture(os.path.join(work_dir, 'ecb_rates.bin'), currencies=currencies, years=years, seed=seed)
+    cpi_fixture_file = os.path.join(work_dir, 'cpi_fixture.json')
+    write_cpi_fixture(cpi_fixture_file, years=years, seed=seed)
+    cpi_cache_file = os.path.join(work_dir, 'cpi_israel.json')
+
+    timings = {'extract_trades': [], 'extract_dividends': [], 'write_tax_forms': []}
+    for ind_repeat in range(num_repeats):
+        if os.path.exists(cpi_cache_file):
+            os.remove(cpi_cache_file)
+        cpi_store = IsraelCpiStore(cache_file=cpi_cache_file, fetcher=get_cpi_fixture_fetcher(cpi_fixture_file))
+
+        start_time = time.perf_counter()
+        closed_lots_list, inds_sorted_close_dates = tax_forms_functions.extract_trades_data_from_csv(
+            work_dir, csv_file_name, cpi_store=cpi_store, engine=engine)
+        timings['extract_trades'] += [time.perf_counter() - start_time]
+
+        start_time = time.perf_counter()
+        dividends_list = tax_forms_functions.extract_dividends_data_from_csv(work_dir, csv_file_name)
+        timings['extract_dividends'] += [time.perf_counter() - start_time]
+
+        start_time = time.perf_counter()
+        tax_forms_functions.write_tax_form_files(work_dir, csv_file_name, closed_lots_list, inds_sorted_close_dates,
+                                                 dividends_list)
+        timings['write_tax_forms'] += [time.perf_counter() - start_time]
+
+    results = {'version': get_version_label(),
+               'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'size': size,
+               'engine': engine,
+               'statement_config': statement_config,
+               'statement_counts': counts,
+               'num_closed_lots': len(closed_lots_list),
+               'num_dividends': len(dividends_list),
+               'timings': {stage: get_timing_summary(stage_timings) for stage, stage_timings in timings.items()}}
+    return results
+
+
+def save_benchmark_results(results, results_file):
+    """
+    append the results as a single json line, so the file accumulates the results of successive versions.
+    """
+    with open(results_file, 'a') as write_obj:
+        write_obj.write(json.dumps(results) + '\n')
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tax forms generator on a synthetic statement")
+    parser.add_argument("-size", "--size", default='medium', type=str, choices=list(BENCHMARK_SIZES),
+                        help="size of the synthetic statement")
+    parser.add_argument("-repeats", "--repeats", default=3, type=int, help="number of timed runs of every stage")
+    parser.add_argument("-engine", "--engine", default='scalar', type=str, choices=['scalar', 'numpy'],
+                        help="computation engine of the closed lots")
+    parser.add_argument("-currencies", "--currencies", default=['USD'], nargs='+', type=str, help="trade currencies")
+    parser.add_argument("-date_format", "--date_format", default='mixed', type=str,
+                        choices=['iso', 'normal', 'USA', 'mixed'], help="form of the dates in the statement")
+    parser.add_argument("-years", "--years", default=[2023], nargs='+', type=int, help="years of the trades")
+    parser.add_argument("-seed", "--seed", default=0, type=int, help="random seed of the statement")
+    parser.add_argument("-work_dir", "--work_dir", default=None, type=str,
+                        help="directory of the statement, fixtures and outputs (default: a new temporary directory)")
+    parser.add_argument("-output", "--output", default='benchmark_results.jsonl', type=str,
+                        help="json lines file the results are appended to")
+    args = parser.parse_args()
+    results = run_benchmark(size=args.size, num_repeats=args.repeats, engine=args.engine, currencies=args.currencies,
+                            date_format=args.date_format, years=args.years, seed=args.seed, work_dir=args.work_dir)
+    for stage, timing_summary in results['timings'].items():
+        print(stage + ': min ' + '%.3f' % timing_summary['min'] + ' s, median ' + '%.3f' % timing_summary['median']
+              + ' s')
+    save_benchmark_results(results, args.output)
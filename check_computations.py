@@ -0,0 +1,170 @@
+import argparse
+import os
+import tempfile
+
+from aux_functions import get_date_parser, infer_date_slash_format
+from run_stats import RunStats
+from synthetic_statement import write_synthetic_statement, write_fx_fixture, write_cpi_fixture
+
+# a statement with stocks and options, long and short lots, in two currencies, opened up to two years before the
+# trade years
+CHECK_STATEMENT_CONFIG = {'num_stock_trades': 400, 'num_option_trades': 100, 'num_dividends': 200,
+                          'currencies': ['USD', 'GBP'], 'years': [2022, 2023]}
+
+# (description, date strings, expected format, or None if ValueError is expected)
+CHECK_DATE_SLASH_FORMAT_CASES = [
+    ('a day above 12 in the first place is normal', ['05/03/2023', '25/01/2023'], 'normal'),
+    ('a day above 12 in the second place is USA', ['03/05/2023', '01/25/2023'], 'USA'),
+    ('ambiguous dates that keep the file order as normal dates are normal', ['12/01/2023', '01/02/2023'], 'normal'),
+    ('ambiguous dates that keep the file order as USA dates are USA', ['01/12/2023', '02/01/2023'], 'USA'),
+    ('ambiguous dates equally ordered both ways are normal', ['01/02/2023', '01/03/2023'], 'normal'),
+    ('the dates without slashes are ignored', ['2023-12-01', '2023-01-02, 10:00:00', '01/12/2023', '02/01/2023'],
+     'USA'),
+    ('no dates with slashes is normal', ['2023-12-01', '2023-01-02, 10:00:00'], 'normal'),
+    ('mixed normal and USA dates raise ValueError', ['25/01/2023', '01/25/2023'], None)]
+
+
+def write_check_statement(work_dir, csv_file_name, date_format='mixed'):
+    """
+    write the synthetic statement and the FX and CPI fixtures to work_dir, returns the CPI fixture file.
+    """
+    write_synthetic_statement(work_dir + '/' + csv_file_name + '.csv', date_format=date_format,
+                              **CHECK_STATEMENT_CONFIG)
+    write_fx_fixture(os.path.join(work_dir, 'ecb_rates.bin'), currencies=CHECK_STATEMENT_CONFIG['currencies'],
+                     years=CHECK_STATEMENT_CONFIG['years'])
+    cpi_fixture_file = os.path.join(work_dir, 'cpi_fixture.json')
+    write_cpi_fixture(cpi_fixture_file, years=CHECK_STATEMENT_CONFIG['years'])
+    return cpi_fixture_file
+
+
+def get_engine_mismatches(work_dir, csv_file_name, cpi_fixture_file):
+    """
+    compute the closed lots of the statement with both engines of tax_forms_functions.compute_closed_lots, every
+    engine on its own reading of the file. returns the number of closed lots and the (lot index, field) of every
+    computed field whose values are not exactly equal, or of the sort order if it differs.
+    """
+    import tax_forms_functions
+    from cpi_israel import IsraelCpiStore, get_cpi_fixture_fetcher
+
+    cpi_store = IsraelCpiStore(cache_file=os.path.join(work_dir, 'cpi_israel.json'),
+                               fetcher=get_cpi_fixture_fetcher(cpi_fixture_file))
+    engines_results = {}
+    for engine in ['scalar', 'numpy']:
+        engines_results[engine] = tax_forms_functions.extract_trades_data_from_csv(work_dir, csv_file_name,
+                                                                                  cpi_store=cpi_store, engine=engine)
+    closed_lots_scalar, inds_sorted_scalar = engines_results['scalar']
+    closed_lots_numpy, inds_sorted_numpy = engines_results['numpy']
+
+    mismatches = []
+    if len(closed_lots_scalar) != len(closed_lots_numpy):
+        return len(closed_lots_scalar), [(None, 'number of closed lots')]
+    for ind_lot, (closed_lot_scalar, closed_lot_numpy) in enumerate(zip(closed_lots_scalar, closed_lots_numpy)):
+        for field in closed_lot_scalar.computed_fields:
+            value_scalar = getattr(closed_lot_scalar, field)
+            value_numpy = getattr(closed_lot_numpy, field)
+            # the numpy engine must give python floats, so the values are also compared by type
+            if type(value_scalar) is not type(value_numpy) or value_scalar != value_numpy:
+                mismatches += [(ind_lot, field)]
+    if inds_sorted_scalar != inds_sorted_numpy:
+        mismatches += [(None, 'sort order')]
+    return len(closed_lots_scalar), mismatches
+
+
+def check_merge_dividend_events(check):
+    """
+    check tax_forms_functions.merge_dividend_events on events in the order they can appear in the csv file.
+    """
+    from tax_forms_functions import merge_dividend_events
+
+    dividend_events = [('Withholding Tax', 'AAPL', '2023-03-01', 'USD', -2.5),
+                       ('Dividends', 'AAPL', '01/03/2023', 'USD', 10.0),
+                       ('Dividends', 'MSFT', '2023-04-03', 'USD', 8.0),
+                       ('Withholding Tax', 'MSFT', '2023-04-03', 'USD', -2.0),
+                       ('Dividends', 'MSFT', '2023-04-03', 'USD', -8.0),
+                       ('Withholding Tax', 'MSFT', '2023-04-03', 'USD', 2.0),
+                       ('Dividends', 'MSFT', '2023-04-03', 'USD', 8.5),
+                       ('Withholding Tax', 'MSFT', '2023-04-03', 'USD', -2.125),
+                       ('Dividends', 'MSFT', '2023-04-03', 'GBP', 4.0),
+                       ('Dividends', 'MSFT', '2023-07-03', 'USD', 9.0),
+                       ('Withholding Tax', 'KO', '2023-05-02', 'USD', -1.0),
+                       ('Withholding Tax', 'KO', '2023-05-02', 'USD', -0.5)]
+    stats = RunStats()
+    dividends_list = merge_dividend_events(dividend_events, get_date_parser('normal'), stats=stats)
+    dividends_values = [(dividend.ticker, dividend.date, dividend.currency, dividend.amount, dividend.withholding_tax)
+                        for dividend in dividends_list]
+
+    check(dividends_values[0] == ('AAPL', '01/03/2023', 'USD', 10.0, -2.5),
+          'merge_dividend_events: withholding tax before its dividend (in another date form) is added to it')
+    check(dividends_values[1] == ('MSFT', '03/04/2023', 'USD', 8.5, -2.125),
+          'merge_dividend_events: repeated dividend and tax rows, with their reversals, are summed with their sign')
+    check(dividends_values[2:] == [('MSFT', '03/04/2023', 'GBP', 4.0, 0), ('MSFT', '03/07/2023', 'USD', 9.0, 0)],
+          'merge_dividend_events: dividends of another currency or date are not merged, and have no tax')
+    check(len(dividends_list) == 4 and stats.counters.get('unmatched_withholding_tax') == 1,
+          'merge_dividend_events: withholding tax without a dividend is left out and counted once per dividend key')
+    return
+
+
+def check_computations(work_dir=None):
+    """
+    check the computations that have a faster or single-pass form against their expected results: the two engines
+    of compute_closed_lots on the closed lots of a synthetic statement (every computed field of ClosedLot must be
+    exactly equal), infer_date_slash_format on hand-picked dates and on synthetic statements in every date form, and
+    merge_dividend_events on out of order, repeated and unmatched rows. returns the list of failed checks (empty if
+    all passed).
+    """
+    failed_checks = []
+
+    def check(is_passed, description):
+        print(('ok: ' if is_passed else 'FAILED: ') + description)
+        if not is_passed:
+            failed_checks.append(description)
+        return
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='tax_forms_check_')
+    # the default ECB rate store is loaded from the cache dir, so it must point to the fixture before first use
+    os.environ['TAX_FORMS_GENERATOR_CACHE_DIR'] = work_dir
+    import tax_forms_functions
+
+    csv_file_name = 'synthetic_check'
+    cpi_fixture_file = write_check_statement(work_dir, csv_file_name)
+    num_closed_lots, mismatches = get_engine_mismatches(work_dir, csv_file_name, cpi_fixture_file)
+    check(num_closed_lots > 0 and len(mismatches) == 0,
+          'the scalar and numpy engines give the same %d closed lots %s' % (num_closed_lots, mismatches[:5]))
+
+    for description, date_strings, expected_format in CHECK_DATE_SLASH_FORMAT_CASES:
+        try:
+            date_slash_format = infer_date_slash_format(iter(date_strings))
+        except ValueError:
+            date_slash_format = None
+        check(date_slash_format == expected_format, 'infer_date_slash_format: ' + description)
+
+    # the dates of a statement written in every date form are read as written when the format is inferred
+    for date_format in ['normal', 'USA', 'mixed']:
+        csv_file_name = 'synthetic_check_' + date_format
+        write_synthetic_statement(work_dir + '/' + csv_file_name + '.csv', date_format=date_format,
+                                  **CHECK_STATEMENT_CONFIG)
+        expected_data = tax_forms_functions.read_tax_data_from_csv(
+            work_dir, csv_file_name, date_slash_format='USA' if date_format == 'USA' else 'normal')
+        inferred_data = tax_forms_functions.read_tax_data_from_csv(work_dir, csv_file_name)
+        expected_datetimes = [(closed_lot.open_datetime, closed_lot.close_datetime) for closed_lot in expected_data[0]] \
+            + [dividend.datetime for dividend in expected_data[1]]
+        inferred_datetimes = [(closed_lot.open_datetime, closed_lot.close_datetime) for closed_lot in inferred_data[0]] \
+            + [dividend.datetime for dividend in inferred_data[1]]
+        check(inferred_datetimes == expected_datetimes,
+              'infer_date_slash_format: the dates of a statement in the ' + date_format + ' date form')
+
+    check_merge_dividend_events(check)
+    return failed_checks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the closed lots engines, the inference of the date format and "
+                                                 "the merge of the dividends on synthetic data")
+    parser.add_argument("-work_dir", "--work_dir", default=None, type=str,
+                        help="directory of the statements and fixtures (default: a new temporary directory)")
+    args = parser.parse_args()
+    failed_checks = check_computations(work_dir=args.work_dir)
+    if len(failed_checks) > 0:
+        raise SystemExit(str(len(failed_checks)) + ' checks failed')
+    print('all checks passed')
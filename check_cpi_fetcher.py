@@ -0,0 +1,205 @@
+import argparse
+import datetime
+import http.server
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from aux_functions import RateDataError
+from cpi_israel import IsraelCpiStore, fetch_cpi_values_from_cbs, get_cpi_month_key
+from run_stats import RunStats
+
+CHECK_MONTH_KEYS = ['2023-%02d' % month for month in range(1, 13)]
+CHECK_LATENCY = 0.2
+CHECK_TIMEOUT = 1.0
+CHECK_BACKOFF = 0.1
+
+
+def get_check_cpi_value(month_key):
+    year, month = [int(x) for x in month_key.split('-')]
+    return round(100 + (year - 1990) * 2.4 + month * 0.3, 1)
+
+
+class CbsStandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    a local stand-in of the CBS calculator api: every response takes server.latency seconds, the first request of a
+    month in server.unavailable_months answers 503, the first request of a month in server.slow_months takes longer
+    than the client timeout, and the months in server.failing_months always answer 503.
+    """
+
+    def log_message(self, *args):
+        return
+
+    def do_GET(self):
+        server = self.server
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        month, day, year = [int(x) for x in query['toDate'][0].split('-')]
+        month_key = get_cpi_month_key(datetime.date(year, month, day))
+        with server.lock:
+            server.num_requests[month_key] = server.num_requests.get(month_key, 0) + 1
+            num_request = server.num_requests[month_key]
+            server.num_active += 1
+            server.max_active = max(server.max_active, server.num_active)
+        try:
+            delay = server.latency
+            if month_key in server.slow_months and num_request == 1:
+                delay = server.timeout + 0.5
+            time.sleep(delay)
+            if month_key in server.failing_months or (month_key in server.unavailable_months and num_request == 1):
+                status, content = 503, b'unavailable'
+            else:
+                status = 200
+                content = ('<?xml version="1.0"?><root><from_value>100</from_value><to_value>%s</to_value></root>'
+                           % get_check_cpi_value(month_key)).encode()
+            try:
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client gave up on a slow response
+                pass
+        finally:
+            with server.lock:
+                server.num_active -= 1
+        return
+
+
+def start_stand_in_server(unavailable_months=(), slow_months=(), failing_months=(), latency=CHECK_LATENCY,
+                          timeout=CHECK_TIMEOUT):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), CbsStandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.num_requests = {}
+    server.num_active = 0
+    server.max_active = 0
+    server.unavailable_months = set(unavailable_months)
+    server.slow_months = set(slow_months)
+    server.failing_months = set(failing_months)
+    server.latency = latency
+    server.timeout = timeout
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_template = 'http://127.0.0.1:' + str(server.server_address[1]) \
+                   + '/index/data/calculator/120010?value=100&date=1-1-1990&toDate=@MONTH@-@DAY@-@YEAR@&format=xml'
+    return server, url_template
+
+
+def check_cpi_fetcher(max_workers=4):
+    """
+    check fetch_cpi_values_from_cbs against a local stand-in of the CBS api: the months are fetched concurrently (at
+    most max_workers requests at a time), a 503 and a response slower than the timeout are retried once, and a month
+    that keeps failing raises once its retries are used up. every request, retries included, is counted in the stats.
+    returns the list of failed checks (empty if all passed).
+    """
+    failed_checks = []
+
+    def check(is_passed, description):
+        print(('ok: ' if is_passed else 'FAILED: ') + description)
+        if not is_passed:
+            failed_checks.append(description)
+        return
+
+    unavailable_month_key, slow_month_key = CHECK_MONTH_KEYS[2], CHECK_MONTH_KEYS[6]
+    server, url_template = start_stand_in_server(unavailable_months=[unavailable_month_key],
+                                                 slow_months=[slow_month_key])
+    stats = RunStats()
+    try:
+        start_time = time.perf_counter()
+        cpi_values = fetch_cpi_values_from_cbs(CHECK_MONTH_KEYS + CHECK_MONTH_KEYS[:3], url_template=url_template,
+                                               max_workers=max_workers, timeout=CHECK_TIMEOUT, backoff=CHECK_BACKOFF,
+                                               stats=stats)
+        seconds = time.perf_counter() - start_time
+    finally:
+        server.shutdown()
+        server.server_close()
+    print('fetched %d months in %.2f s, requests per month: %s, max concurrent requests: %d'
+          % (len(cpi_values), seconds, server.num_requests, server.max_active))
+    check(cpi_values == {month_key: get_check_cpi_value(month_key) for month_key in CHECK_MONTH_KEYS},
+          'all the months are resolved with their values')
+    check(all(num_requests == 1 for month_key, num_requests in server.num_requests.items()
+              if month_key not in [unavailable_month_key, slow_month_key]),
+          'the duplicate months are requested once')
+    check(server.num_requests.get(unavailable_month_key) == 2, 'a 503 is retried once')
+    check(server.num_requests.get(slow_month_key) == 2, 'a response slower than the timeout is retried once')
+    check(stats.counters.get('http_requests') == sum(server.num_requests.values()),
+          'every request, retries included, is counted in the stats')
+    check(1 < server.max_active <= max_workers, 'the requests run concurrently, at most max_workers at a time')
+    # the serial time of the requests, the slow month waits for its timeout before its retry
+    serial_seconds = len(CHECK_MONTH_KEYS) * CHECK_LATENCY + CHECK_TIMEOUT
+    check(seconds < serial_seconds, 'the fetch takes less than the serial time of the requests (%.2f s)'
+          % serial_seconds)
+
+    failing_month_key = CHECK_MONTH_KEYS[0]
+    num_retries = 2
+    server, url_template = start_stand_in_server(failing_months=[failing_month_key], latency=0)
+    try:
+        fetch_cpi_values_from_cbs([failing_month_key], url_template=url_template, timeout=CHECK_TIMEOUT,
+                                  num_retries=num_retries, backoff=CHECK_BACKOFF)
+        is_raised = False
+    except ValueError:
+        is_raised = True
+    finally:
+        server.shutdown()
+        server.server_close()
+    check(is_raised and server.num_requests.get(failing_month_key) == num_retries + 1,
+          'a month that keeps failing raises after %d retries' % num_retries)
+
+    # a port nobody listens on, the connection is refused
+    with socket.socket() as closed_socket:
+        closed_socket.bind(('127.0.0.1', 0))
+        closed_port = closed_socket.getsockname()[1]
+    try:
+        fetch_cpi_values_from_cbs([failing_month_key], url_template=url_template.replace(
+            ':' + str(server.server_address[1]) + '/', ':' + str(closed_port) + '/'), timeout=CHECK_TIMEOUT,
+            num_retries=1, backoff=CHECK_BACKOFF)
+        raised_error = None
+    except Exception as error:
+        raised_error = error
+    check(isinstance(raised_error, RateDataError), 'an unreachable api raises RateDataError (%s)' % type(raised_error).__name__)
+
+    check(check_cpi_store_lock(), 'a prefetch of stored months does not wait for the fetch of another run')
+    return failed_checks
+
+
+def check_cpi_store_lock():
+    """
+    while a run of a shared IsraelCpiStore fetches its missing months, a run whose months are all in the store must
+    return at once instead of waiting for the fetch.
+    """
+    fetch_started = threading.Event()
+    fetch_released = threading.Event()
+
+    def fetch_slowly(month_keys, stats=None):
+        fetch_started.set()
+        fetch_released.wait(10)
+        return {month_key: get_check_cpi_value(month_key) for month_key in month_keys}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cpi_store = IsraelCpiStore(cache_file=os.path.join(cache_dir, 'cpi_israel.json'), fetcher=fetch_slowly)
+        fetch_released.set()
+        cpi_store.prefetch([datetime.date(2023, 1, 1)])
+        fetch_released.clear()
+        fetch_thread = threading.Thread(target=cpi_store.prefetch, args=([datetime.date(2023, 2, 1)],))
+        fetch_thread.start()
+        fetch_started.wait(10)
+        start_time = time.perf_counter()
+        cpi_store.prefetch([datetime.date(2023, 1, 1)])
+        seconds = time.perf_counter() - start_time
+        fetch_released.set()
+        fetch_thread.join()
+        is_passed = seconds < 1 and cpi_store.get_value(datetime.date(2023, 2, 1)) == get_check_cpi_value('2023-02')
+    return is_passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the retries, timeouts and concurrency of the CPI fetcher "
+                                                 "against a local stand-in of the CBS api")
+    parser.add_argument("-workers", "--workers", default=4, type=int, help="number of concurrent requests")
+    args = parser.parse_args()
+    failed_checks = check_cpi_fetcher(max_workers=args.workers)
+    if len(failed_checks) > 0:
+        raise SystemExit(str(len(failed_checks)) + ' checks failed')
+    print('all checks passed')
@@ -0,0 +1,144 @@
+import argparse
+import os
+import tempfile
+
+from synthetic_statement import write_synthetic_statement, write_fx_fixture, write_cpi_fixture
+
+# a statement with more closed lots and dividends than the rows of the template
+CHECK_STATEMENT_CONFIG = {'num_stock_trades': 150, 'num_option_trades': 30, 'num_dividends': 250,
+                          'currencies': ['USD', 'GBP'], 'years': [2023]}
+CHECK_STYLE_ATTRIBUTES = ['font', 'fill', 'border', 'alignment', 'number_format', 'protection']
+
+
+def get_expected_sheet_values(sorted_closed_lots, dividends_list):
+    """
+    the values the tax forms must have, {sheet name: {(row, column index): value}}, built from the records and the
+    column constants of tax_forms_functions.
+    """
+    from openpyxl.utils import column_index_from_string
+    from tax_forms_functions import CAPITAL_GAINS_SHEET_COLUMNS, CAPITAL_GAINS_SHEETS, DIVIDENDS_SHEET_COLUMNS, \
+        get_capital_gains_totals, get_dividends_totals
+
+    expected_values = {}
+    _, total_sell_amount_ILS, totals_profit_and_loss_ILS = get_capital_gains_totals(sorted_closed_lots)
+    for ind_sheet, (sheet_name, ratio_name, open_value_adjusted_name, profit_ILS_name) \
+            in enumerate(CAPITAL_GAINS_SHEETS):
+        sheet_values = {(5, column_index_from_string('S')): totals_profit_and_loss_ILS[ind_sheet],
+                        (5, column_index_from_string('T')): total_sell_amount_ILS}
+        for ind_line, closed_lot in enumerate(sorted_closed_lots):
+            num_row = 6 + ind_line
+            sheet_values[(num_row, 2)] = ind_line + 1
+            for col, field in CAPITAL_GAINS_SHEET_COLUMNS:
+                sheet_values[(num_row, column_index_from_string(col))] = getattr(closed_lot, field)
+            sheet_values[(num_row, 12)] = getattr(closed_lot, ratio_name)
+            sheet_values[(num_row, 13)] = getattr(closed_lot, open_value_adjusted_name)
+            profit_ILS = getattr(closed_lot, profit_ILS_name)
+            sheet_values[(num_row, 16 if profit_ILS >= 0 else 17)] = profit_ILS
+        expected_values[sheet_name] = sheet_values
+
+    sheet_values = dict(zip([(5, column_index_from_string(col)) for col in ['I', 'J', 'L']],
+                            get_dividends_totals(dividends_list)))
+    for ind_line, dividend in enumerate(dividends_list):
+        num_row = 6 + ind_line
+        sheet_values[(num_row, 2)] = ind_line + 1
+        for col, field in DIVIDENDS_SHEET_COLUMNS:
+            sheet_values[(num_row, column_index_from_string(col))] = getattr(dividend, field)
+    expected_values['Dividends'] = sheet_values
+    return expected_values
+
+
+def check_tax_form_workbook(work_dir=None):
+    """
+    check the workbook written by tax_forms_functions.write_tax_form_files, a write-only copy of the template that
+    relies on openpyxl internals (see tax_forms_functions.get_write_only_template_copy), against the template as
+    openpyxl.load_workbook reads it: the sheets and their settings, the style of every cell of the template, the values
+    of the template that are not overwritten, and the values of the records and totals, on a synthetic statement
+    with more records than the rows of the template. returns the list of failed checks (empty if all passed).
+    """
+    failed_checks = []
+
+    def check(is_passed, description):
+        print(('ok: ' if is_passed else 'FAILED: ') + description)
+        if not is_passed:
+            failed_checks.append(description)
+        return
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='tax_forms_check_')
+    # the default ECB rate store is loaded from the cache dir, so it must point to the fixture before first use
+    os.environ['TAX_FORMS_GENERATOR_CACHE_DIR'] = work_dir
+    import openpyxl
+    import tax_forms_functions
+    from cpi_israel import IsraelCpiStore, get_cpi_fixture_fetcher
+
+    csv_file_name = 'synthetic_check'
+    write_synthetic_statement(work_dir + '/' + csv_file_name + '.csv', **CHECK_STATEMENT_CONFIG)
+    write_fx_fixture(os.path.join(work_dir, 'ecb_rates.bin'), currencies=CHECK_STATEMENT_CONFIG['currencies'],
+                     years=CHECK_STATEMENT_CONFIG['years'])
+    cpi_fixture_file = os.path.join(work_dir, 'cpi_fixture.json')
+    write_cpi_fixture(cpi_fixture_file, years=CHECK_STATEMENT_CONFIG['years'])
+    cpi_store = IsraelCpiStore(cache_file=os.path.join(work_dir, 'cpi_israel.json'),
+                               fetcher=get_cpi_fixture_fetcher(cpi_fixture_file))
+    closed_lots_list, inds_sorted_close_dates = tax_forms_functions.extract_trades_data_from_csv(
+        work_dir, csv_file_name, cpi_store=cpi_store)
+    dividends_list = tax_forms_functions.extract_dividends_data_from_csv(work_dir, csv_file_name)
+    tax_forms_functions.write_tax_form_files(work_dir, csv_file_name, closed_lots_list, inds_sorted_close_dates,
+                                             dividends_list)
+
+    template = openpyxl.load_workbook(os.path.dirname(os.path.abspath(__file__)) + '/tax_forms_template.xlsx')
+    xfile = openpyxl.load_workbook(work_dir + '/tax_forms_' + csv_file_name + '.xlsx')
+    expected_values = get_expected_sheet_values([closed_lots_list[ind_sort] for ind_sort in inds_sorted_close_dates],
+                                                dividends_list)
+    check(xfile.sheetnames == template.sheetnames, 'the sheets of the template, in its order')
+    for template_sheet in template.worksheets:
+        if template_sheet.title not in xfile.sheetnames:
+            continue
+        sheet = xfile[template_sheet.title]
+        title = template_sheet.title
+        check(repr(sheet.views) == repr(template_sheet.views)
+              and repr(sheet.sheet_format) == repr(template_sheet.sheet_format)
+              and repr(sheet.page_setup) == repr(template_sheet.page_setup)
+              and repr(sheet.page_margins) == repr(template_sheet.page_margins),
+              title + ': the views, format and page setup of the template')
+        check({col: (dimension.width, dimension.hidden) for col, dimension in sheet.column_dimensions.items()}
+              == {col: (dimension.width, dimension.hidden)
+                  for col, dimension in template_sheet.column_dimensions.items()},
+              title + ': the column widths of the template')
+        check({num_row: dimension.height for num_row, dimension in sheet.row_dimensions.items()
+               if dimension.height is not None}
+              == {num_row: dimension.height for num_row, dimension in template_sheet.row_dimensions.items()
+                  if dimension.height is not None},
+              title + ': the row heights of the template')
+
+        sheet_values = expected_values[title]
+        style_mismatches = []
+        value_mismatches = []
+        for template_row in template_sheet.iter_rows():
+            for template_cell in template_row:
+                cell = sheet.cell(row=template_cell.row, column=template_cell.column)
+                style_mismatches += [(cell.coordinate, attribute) for attribute in CHECK_STYLE_ATTRIBUTES
+                                     if repr(getattr(cell, attribute)) != repr(getattr(template_cell, attribute))]
+                if (cell.row, cell.column) not in sheet_values and cell.value != template_cell.value:
+                    value_mismatches += [cell.coordinate]
+        for (num_row, col_index), value in sheet_values.items():
+            if isinstance(value, float):
+                # the numbers are stored with 16 significant digits, as Excel keeps them
+                value = float('%.16g' % value)
+            if sheet.cell(row=num_row, column=col_index).value != value:
+                value_mismatches += [sheet.cell(row=num_row, column=col_index).coordinate]
+        check(len(style_mismatches) == 0, title + ': the style of every cell of the template %s'
+              % style_mismatches[:5])
+        check(len(value_mismatches) == 0, title + ': the values of the template, the records and the totals %s'
+              % value_mismatches[:5])
+    return failed_checks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the tax forms workbook against the template it copies")
+    parser.add_argument("-work_dir", "--work_dir", default=None, type=str,
+                        help="directory of the statement, fixtures and workbook (default: a new temporary directory)")
+    args = parser.parse_args()
+    failed_checks = check_tax_form_workbook(work_dir=args.work_dir)
+    if len(failed_checks) > 0:
+        raise SystemExit(str(len(failed_checks)) + ' checks failed')
+    print('all checks passed')
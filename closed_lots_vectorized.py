@@ -0,0 +1,104 @@
+import operator
+
+import numpy as np
+
+from records import ClosedLot
+
+# the profits of form 1325 that are clamped to 0 when the two profits (or losses) disagree in sign
+CLAMPED_PROFIT_FIELDS = ['profit_ILS_forex', 'profit_ILS_cpi']
+
+
+def get_column_by_keys(keys, get_value):
+    """
+    a float column of get_value(*key) for every key, where get_value is called once per distinct key.
+    """
+    values_dict = {key: get_value(*key) for key in set(keys)}
+    return np.fromiter(map(values_dict.__getitem__, keys), dtype=np.float64, count=len(keys))
+
+
+def get_clamped_profit(is_profit, profit_trivial, profit_adjusted):
+    """
+    the smaller of the two profits (and not below 0) of the profitable lots, the smaller of the two losses (and not
+    above 0) of the others. returns the column and the mask of the lots where it is clamped to 0.
+    """
+    profit = np.where(is_profit, np.minimum(profit_trivial, profit_adjusted),
+                      np.maximum(profit_trivial, profit_adjusted))
+    is_clamped = np.where(is_profit, profit < 0, profit > 0)
+    return np.where(is_clamped, 0.0, profit), is_clamped
+
+
+def get_closed_lots_columns(closed_lots_list, fx_table, cpi_store):
+    """
+    load the parsed closed lots, with their FX and CPI values, into column arrays.
+    """
+    columns = {}
+    input_values = np.array(list(map(operator.attrgetter('quantity', 'open_price', 'close_price', 'close_fee'),
+                                     closed_lots_list)), dtype=np.float64).reshape(-1, 4)
+    columns['quantity'] = input_values[:, 0]
+    columns['open_price'] = input_values[:, 1]
+    columns['close_price'] = input_values[:, 2]
+    columns['close_fee'] = input_values[:, 3]
+    columns['is_option'] = np.array(list(map(operator.attrgetter('asset_category'), closed_lots_list))) \
+                           == 'Equity and Index Options'
+
+    open_keys = list(map(operator.attrgetter('currency', 'open_datetime'), closed_lots_list))
+    close_keys = list(map(operator.attrgetter('currency', 'close_datetime'), closed_lots_list))
+    columns['open_currency_factor'] = get_column_by_keys(open_keys, fx_table.get_factor)
+    columns['close_currency_factor'] = get_column_by_keys(close_keys, fx_table.get_factor)
+    columns['open_cpi'] = get_column_by_keys([key[1:] for key in open_keys], cpi_store.get_value)
+    columns['close_cpi'] = get_column_by_keys([key[1:] for key in close_keys], cpi_store.get_value)
+    return columns
+
+
+def compute_closed_lots_columns(columns):
+    """
+    the calculation of tax_forms_functions.compute_closed_lot on whole columns. the operations are applied in the same
+    order as in the scalar calculation, so the results are identical.
+    """
+    # prices written per single stock but option contract are for 100 stock units
+    multiplier = np.where(columns['is_option'], 100.0, 1.0)
+    columns['close_value'] = columns['quantity'] * columns['close_price'] * multiplier
+    columns['open_value'] = columns['quantity'] * columns['open_price'] * multiplier
+
+    # reducing the fee from close_value, but after the multiplication in case of options
+    columns['close_value'] = columns['close_value'] - columns['close_fee']
+    columns['profit'] = columns['close_value'] - columns['open_value']
+
+    columns['currency_factor_ratio'] = columns['close_currency_factor'] / columns['open_currency_factor']
+    columns['cpi_ratio'] = columns['close_cpi'] / columns['open_cpi']
+
+    columns['open_value_ILS'] = columns['open_value'] * columns['open_currency_factor']
+    columns['open_value_ILS_adjusted_forex'] = columns['open_value_ILS'] * columns['currency_factor_ratio']
+    columns['open_value_ILS_adjusted_cpi'] = columns['open_value_ILS'] * columns['cpi_ratio']
+    columns['close_value_ILS'] = columns['close_value'] * columns['close_currency_factor']
+    profit_trivial = columns['close_value_ILS'] - columns['open_value_ILS']
+    profit_adjusted_forex = columns['close_value_ILS'] - columns['open_value_ILS_adjusted_forex']
+    profit_adjusted_cpi = columns['close_value_ILS'] - columns['open_value_ILS_adjusted_cpi']
+
+    # a profit is the smaller of the two profits (and not below 0), a loss is the smaller of the two losses
+    is_profit = columns['profit'] >= 0
+    columns['profit_ILS_forex'], columns['profit_ILS_forex_is_clamped'] = get_clamped_profit(
+        is_profit, profit_trivial, profit_adjusted_forex)
+    columns['profit_ILS_cpi'], columns['profit_ILS_cpi_is_clamped'] = get_clamped_profit(
+        is_profit, profit_trivial, profit_adjusted_cpi)
+    return columns
+
+
+def compute_closed_lots_vectorized(closed_lots_list, fx_table, cpi_store):
+    """
+    batch alternative to calling tax_forms_functions.compute_closed_lot for every lot.
+    the results are written back to the closed lots.
+    """
+    if len(closed_lots_list) == 0:
+        return
+    columns = compute_closed_lots_columns(get_closed_lots_columns(closed_lots_list, fx_table, cpi_store))
+    computed_columns = [columns[field].tolist() for field in ClosedLot.computed_fields]
+    # the scalar calculation clamps to the int 0 of max and min, which the plain table exports write as 0 (not 0.0)
+    for field in CLAMPED_PROFIT_FIELDS:
+        computed_column = computed_columns[ClosedLot.computed_fields.index(field)]
+        for ind_lot in np.flatnonzero(columns[field + '_is_clamped']).tolist():
+            computed_column[ind_lot] = 0
+    computed_values = zip(*computed_columns)
+    for closed_lot, values in zip(closed_lots_list, computed_values):
+        closed_lot.set_computed_values(values)
+    return
@@ -1,22 +1,79 @@
-import requests
-from lxml import etree
+import concurrent.futures
+import datetime
+import json
+import os
+import threading
+import time
 
+from aux_functions import get_cache_dir, RateDataError
 
-def get_israel_cpi_value(date_input):
+CPI_URL_TEMPLATE = ('https://api.cbs.gov.il/index/data/calculator/120010?value=100&date=1-1-1990'
+                    '&toDate=@MONTH@-@DAY@-@YEAR@&format=xml&download=false')
+
+# the CBS publishes the CPI of a month on the 15th of the following month. Before that the api answers with the last
+# published index, so such a value is provisional and is refetched once it is older than the refresh age.
+CPI_PUBLICATION_DAY = 16
+CPI_PROVISIONAL_REFRESH_AGE = datetime.timedelta(hours=12)
+
+# fetching from the CBS api: the number of concurrent requests, the timeout of a request in seconds, and the retries
+# of failed requests (connection errors, timeouts, 429 and 5xx), waiting backoff * 2^attempt seconds between them
+CPI_MAX_CONCURRENT_REQUESTS = 8
+CPI_REQUEST_TIMEOUT = 10
+CPI_REQUEST_RETRIES = 3
+CPI_REQUEST_BACKOFF = 0.5
+
+
+def get_cpi_month_key(date_input):
     """
-    Load the israeli CPI data using the israeli CBI (Central Bureau of Statistics) api.
+    the CPI is published once a month, so every date is mapped to its index month, in the form 'YYYY-MM'.
+    """
+    return '%04d-%02d' % (date_input.year, date_input.month)
+
+
+def get_cpi_publication_datetime(month_key):
+    """
+    the datetime from which the CPI value of the month is final.
+    """
+    year, month = [int(x) for x in month_key.split('-')]
+    if month == 12:
+        year, month = year + 1, 1
+    else:
+        month += 1
+    return datetime.datetime(year, month, CPI_PUBLICATION_DAY)
+
+
+def fetch_cpi_value_from_cbs(month_key, session=None, url_template=CPI_URL_TEMPLATE, timeout=CPI_REQUEST_TIMEOUT,
+                             num_retries=CPI_REQUEST_RETRIES, backoff=CPI_REQUEST_BACKOFF, stats=None):
+    """
+    Load a single israeli CPI value using the israeli CBI (Central Bureau of Statistics) api.
     The returned value is relative to a value of 100 in the date 1-1-1990.
+    Every request (including retries) is counted in stats (http_requests) if given.
     """
+    import requests
+    from lxml import etree
 
-    # URL of the XML data
-    url_template = ('https://api.cbs.gov.il/index/data/calculator/120010?value=100&date=1-1-1990'
-                    '&toDate=@MONTH@-@DAY@-@YEAR@&format=xml&download=false')
-    url = url_template.replace('@DAY@', str(date_input.day))
-    url = url.replace('@MONTH@', str(date_input.month))
-    url = url.replace('@YEAR@', str(date_input.year))
+    year, month = [int(x) for x in month_key.split('-')]
+    url = url_template.replace('@DAY@', '1')
+    url = url.replace('@MONTH@', str(month))
+    url = url.replace('@YEAR@', str(year))
+    if session is None:
+        session = requests
 
-    # Fetch the XML content from the URL
-    response = requests.get(url)
+    for attempt in range(num_retries + 1):
+        # Fetch the XML content from the URL, retrying failures that may be temporary
+        try:
+            if stats is not None:
+                stats.count('http_requests')
+            response = session.get(url, timeout=timeout)
+            is_retryable = response.status_code == 429 or response.status_code >= 500
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if attempt == num_retries:
+                print('url:', url)
+                raise RateDataError(f"Failed to fetch data from url: {error!r}") from error
+            is_retryable = True
+        if not is_retryable or attempt == num_retries:
+            break
+        time.sleep(backoff * 2 ** attempt)
 
     # Check if the request was successful
     if response.status_code == 200:
@@ -26,11 +83,166 @@ def get_israel_cpi_value(date_input):
         # Load all the tags in the XML
         xml_data_dict = {}
         for element in root.iter():
-            # print(element.tag, element.text)
             xml_data_dict[element.tag] = element.text
     else:
         print('url:', url)
-        raise ValueError(f"Failed to fetch data from url: Status code {response.status_code}")
+        raise RateDataError(f"Failed to fetch data from url: Status code {response.status_code}")
 
-    cpi = float(xml_data_dict['to_value'])
-    return cpi
+    return float(xml_data_dict['to_value'])
+
+
+def fetch_cpi_values_from_cbs(month_keys, url_template=CPI_URL_TEMPLATE, max_workers=CPI_MAX_CONCURRENT_REQUESTS,
+                              timeout=CPI_REQUEST_TIMEOUT, num_retries=CPI_REQUEST_RETRIES,
+                              backoff=CPI_REQUEST_BACKOFF, stats=None):
+    """
+    the default fetcher of IsraelCpiStore: the CBS calculator api answers a single date per request, so the distinct
+    requested months are fetched concurrently by a bounded thread pool, over a pool of reused connections.
+    returns only when all the values are resolved, and raises if any of them failed.
+    """
+    import requests
+
+    month_keys = sorted(set(month_keys))
+    if len(month_keys) == 0:
+        return {}
+    num_workers = min(max_workers, len(month_keys))
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=num_workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as pool:
+            futures = {month_key: pool.submit(fetch_cpi_value_from_cbs, month_key, session=session,
+                                              url_template=url_template, timeout=timeout, num_retries=num_retries,
+                                              backoff=backoff, stats=stats)
+                       for month_key in month_keys}
+            cpi_values = {month_key: future.result() for month_key, future in futures.items()}
+    return cpi_values
+
+
+def get_cpi_fixture_fetcher(fixture_file):
+    """
+    a fetcher that reads the CPI values from a local json file of the form {'YYYY-MM': value}, used for offline runs.
+    """
+    with open(fixture_file, 'r') as read_obj:
+        fixture_values = json.load(read_obj)
+
+    def fetch_cpi_values_from_fixture(month_keys, stats=None):
+        missing_month_keys = [month_key for month_key in month_keys if month_key not in fixture_values]
+        if len(missing_month_keys) > 0:
+            raise RateDataError('CPI fixture file is missing months', missing_month_keys)
+        return {month_key: float(fixture_values[month_key]) for month_key in month_keys}
+
+    return fetch_cpi_values_from_fixture
+
+
+class IsraelCpiStore:
+    """
+    Persistent store of the israeli CPI values, keyed by index month.
+    Values are kept in memory and in a json file on disk. The missing months of a run are fetched together in a single
+    call to the fetcher, which is any function that receives a list of 'YYYY-MM' keys (and the stats of the run as
+    the stats keyword, to count its requests) and returns {key: value}.
+    Final values are never fetched again, provisional values (see CPI_PUBLICATION_DAY) are refreshed when stale.
+    """
+
+    def __init__(self, cache_file=None, fetcher=fetch_cpi_values_from_cbs):
+        if cache_file is None:
+            cache_file = os.path.join(get_cache_dir(), 'cpi_israel.json')
+        self.cache_file = cache_file
+        self.fetcher = fetcher
+        self.cpi_dict = {}
+        self.checked_month_keys = set()
+        # the store can be shared by threads (see tax_forms_server), the lock guards the values and the cache file, it
+        # is not held while the months are fetched
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r') as read_obj:
+                self.cpi_dict = json.load(read_obj)
+
+    def is_final(self, month_key):
+        if month_key not in self.cpi_dict:
+            return False
+        fetch_datetime = datetime.datetime.fromisoformat(self.cpi_dict[month_key]['fetched'])
+        return fetch_datetime >= get_cpi_publication_datetime(month_key)
+
+    def is_stale(self, month_key, now=None):
+        if month_key not in self.cpi_dict:
+            return True
+        if self.is_final(month_key):
+            return False
+        if now is None:
+            now = datetime.datetime.now()
+        fetch_datetime = datetime.datetime.fromisoformat(self.cpi_dict[month_key]['fetched'])
+        return now - fetch_datetime > CPI_PROVISIONAL_REFRESH_AGE
+
+    def prefetch(self, dates, stats=None):
+        """
+        make sure the CPI values of all the dates are available, fetching all the missing months at once.
+        the hits and misses of the months (and the requests of the fetcher) are counted in stats if given, so the
+        counts of a run are its own when the store is shared by concurrent runs.
+        """
+        month_keys = sorted(set(get_cpi_month_key(date_input) for date_input in dates))
+        with self.lock:
+            now = datetime.datetime.now()
+            missing_month_keys = [month_key for month_key in month_keys if self.is_stale(month_key, now=now)]
+            self.hits += len(month_keys) - len(missing_month_keys)
+            self.misses += len(missing_month_keys)
+            if len(missing_month_keys) == 0:
+                self.checked_month_keys.update(month_keys)
+        if stats is not None:
+            stats.count('cpi_hits', len(month_keys) - len(missing_month_keys))
+            stats.count('cpi_misses', len(missing_month_keys))
+        if len(missing_month_keys) == 0:
+            return
+
+        # the months are fetched outside the lock, so the runs whose months are all in the store do not wait for it
+        cpi_values = self.fetcher(missing_month_keys, stats=stats)
+        with self.lock:
+            for month_key in missing_month_keys:
+                self.cpi_dict[month_key] = {'value': cpi_values[month_key], 'fetched': now.isoformat()}
+            self.save()
+            self.checked_month_keys.update(month_keys)
+        return
+
+    def get_value(self, date_input):
+        month_key = get_cpi_month_key(date_input)
+        if month_key not in self.checked_month_keys:
+            self.prefetch([date_input])
+        return self.cpi_dict[month_key]['value']
+
+    def get_stats(self):
+        # the counts of all the runs of the process, a miss is a month passed to the fetcher
+        return {'cpi_hits': self.hits, 'cpi_misses': self.misses}
+
+    def save(self):
+        # values saved meanwhile by other processes (e.g. batch workers) are kept
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r') as read_obj:
+                saved_cpi_dict = json.load(read_obj)
+            for month_key, cpi_entry in saved_cpi_dict.items():
+                if month_key not in self.cpi_dict or cpi_entry['fetched'] > self.cpi_dict[month_key]['fetched']:
+                    self.cpi_dict[month_key] = cpi_entry
+        tmp_file = self.cache_file + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_file, 'w') as write_obj:
+            json.dump(self.cpi_dict, write_obj, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)
+        return
+
+
+_default_cpi_store = None
+
+
+def get_default_cpi_store():
+    global _default_cpi_store
+    if _default_cpi_store is None:
+        _default_cpi_store = IsraelCpiStore()
+    return _default_cpi_store
+
+
+def get_israel_cpi_value(date_input):
+    """
+    Load the israeli CPI data using the israeli CBI (Central Bureau of Statistics) api.
+    The returned value is relative to a value of 100 in the date 1-1-1990.
+    Values are served from the default IsraelCpiStore, and only fetched from the api when missing or stale.
+    """
+    return get_default_cpi_store().get_value(date_input)
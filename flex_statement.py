@@ -0,0 +1,141 @@
+import datetime
+
+from records import Trade, ClosedLot
+from run_stats import RunStats
+from tax_forms_functions import merge_dividend_events
+
+# the asset categories of the Flex Query (assetCategory attribute) that are reported in form 1325, with their names in
+# the activity statement csv file
+FLEX_ASSET_CATEGORIES = {'STK': 'Stocks', 'OPT': 'Equity and Index Options'}
+FLEX_DIVIDEND_TYPES = {'Dividends': 'Dividends', 'Withholding Tax': 'Withholding Tax'}
+
+
+def get_flex_date_parser():
+    """
+    returns a function that parses the dates of a Flex Query, which have a fixed form set in the query:
+    yyyyMMdd or yyyy-MM-dd, optionally followed by the time HHmmss or HH:mm:ss after a ';', ',' or space.
+    the result of every distinct string is cached.
+    """
+    parsed_datetimes = {}
+
+    def parse_flex_date(datetime_string):
+        if datetime_string not in parsed_datetimes:
+            date_string, _, time_string = datetime_string.replace(';', ' ').replace(',', ' ').strip().partition(' ')
+            date_digits = date_string.replace('-', '')
+            time_digits = time_string.strip().replace(':', '') or '000000'
+            if len(date_digits) != 8 or len(time_digits) != 6 or not (date_digits + time_digits).isdigit():
+                raise ValueError('invalid Flex Query date', datetime_string)
+            parsed_datetimes[datetime_string] = datetime.datetime(int(date_digits[:4]), int(date_digits[4:6]),
+                                                                  int(date_digits[6:]), int(time_digits[:2]),
+                                                                  int(time_digits[2:4]), int(time_digits[4:]))
+        return parsed_datetimes[datetime_string]
+
+    return parse_flex_date
+
+
+def get_flex_day(datetime_string):
+    """
+    the date part of a Flex Query date, which may be followed by the time after a ';', ',' or space.
+    """
+    return datetime_string.replace(';', ' ').replace(',', ' ').split()[0]
+
+
+def iter_flex_elements(xml_file, tags):
+    """
+    iterate over the attributes of the elements with the given tags in the Flex Query xml file, reading it
+    incrementally: every element (of any tag) is cleared at its end, together with the siblings before it, so the
+    memory stays flat on large files.
+    """
+    from lxml import etree
+
+    for _, element in etree.iterparse(xml_file, events=('end',)):
+        if element.tag in tags:
+            yield element.tag, dict(element.attrib)
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return
+
+
+def get_flex_lot_open_price(lot_attributes, asset_category):
+    """
+    the open price of a closed lot adjusted for fees (as the T. Price of the ClosedLot rows of the csv file) is its
+    cost basis per unit, the tradePrice attribute is used when the cost is not in the query.
+    """
+    cost = lot_attributes.get('cost', '')
+    quantity = float(lot_attributes['quantity'])
+    if cost == '' or quantity == 0:
+        return float(lot_attributes['tradePrice'])
+    multiplier = 100 if asset_category == 'Equity and Index Options' else 1
+    return abs(float(cost) / quantity) / multiplier
+
+
+def read_flex_statement(xml_file, closed_lots_list, dividend_events, parse_date):
+    """
+    read the trades, closed lots and cash transactions of a Flex Query xml file (possibly of several accounts) in a
+    single incremental pass. every closed lot (a Lot element, or a Trade with levelOfDetail CLOSED_LOT) is matched with
+    the closing Trade (levelOfDetail EXECUTION) that precedes it, as in the csv file.
+    the closed lots are appended to closed_lots_list, with their dates parsed, and the dividends and withholding tax to
+    dividend_events, as in tax_forms_functions.get_dividends_section_handler.
+    returns the number of elements read.
+    """
+    previous_trade = None
+    num_elements = 0
+    for tag, attributes in iter_flex_elements(xml_file, ('Trade', 'Lot', 'CashTransaction')):
+        num_elements += 1
+        if tag == 'CashTransaction':
+            section = FLEX_DIVIDEND_TYPES.get(attributes.get('type'))
+            if section is None or attributes.get('levelOfDetail', 'DETAIL') not in ['DETAIL', '']:
+                continue
+            # the dividends and their withholding tax are matched by their day, which is their date in the csv file
+            dividend_events.append((section, attributes.get('symbol', ''),
+                                    get_flex_day(attributes.get('dateTime') or attributes['reportDate']),
+                                    attributes['currency'], float(attributes['amount'])))
+            continue
+
+        asset_category = FLEX_ASSET_CATEGORIES.get(attributes.get('assetCategory'))
+        if asset_category is None:
+            continue
+        level_of_detail = attributes.get('levelOfDetail', 'EXECUTION' if tag == 'Trade' else 'CLOSED_LOT')
+        if level_of_detail == 'EXECUTION':
+            previous_trade = Trade(attributes['currency'], attributes['symbol'], parse_date(attributes['dateTime']),
+                                   float(attributes['quantity']), float(attributes['tradePrice']),
+                                   abs(float(attributes.get('ibCommission') or 0)))
+        elif level_of_detail == 'CLOSED_LOT' and previous_trade is not None:
+            # the lot is the opposite position of the trade that closes it (a sell closes a long lot)
+            quantity = abs(float(attributes['quantity']))
+            if previous_trade.quantity > 0:
+                quantity = -quantity
+            open_datetime_string = attributes.get('openDateTime') or attributes['dateTime']
+            closed_lots_list.append(ClosedLot(currency=attributes['currency'],
+                                              ticker=attributes['symbol'],
+                                              asset_category=asset_category,
+                                              open_datetime=parse_date(open_datetime_string),
+                                              close_datetime=previous_trade.datetime,
+                                              quantity=quantity,
+                                              open_price=get_flex_lot_open_price(attributes, asset_category),
+                                              close_price=previous_trade.price,
+                                              close_fee=previous_trade.fee))
+    return num_elements
+
+
+def read_tax_data_from_flex_xml(xml_file, stats=None):
+    """
+    read the closed lots and the dividends (before conversion to ILS) of a Flex Query xml file, the same records as
+    tax_forms_functions.read_tax_data_from_csv. the dates of a Flex Query have a fixed form, so nothing is inferred.
+    raises ValueError if the file has no trades nor cash transactions.
+    """
+    if stats is None:
+        stats = RunStats()
+    closed_lots_list = []
+    dividend_events = []
+    parse_date = get_flex_date_parser()
+    with stats.stage('parse'):
+        num_elements = read_flex_statement(xml_file, closed_lots_list, dividend_events, parse_date)
+        if num_elements == 0:
+            raise ValueError('no Trade, Lot or CashTransaction elements in the Flex Query xml file', xml_file)
+        dividends_list = merge_dividend_events(dividend_events, parse_date, stats=stats)
+    stats.count('elements_read', num_elements)
+    stats.count('closed_lots', len(closed_lots_list))
+    stats.count('dividends', len(dividends_list))
+    return closed_lots_list, dividends_list
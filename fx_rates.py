@@ -0,0 +1,275 @@
+import array
+import datetime
+import io
+import json
+import math
+import os
+import sys
+import threading
+import zipfile
+
+from aux_functions import get_cache_dir, RateDataError
+
+ECB_HISTORY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+# a snapshot that ends before a date of the statement is downloaded again, unless it was downloaded less than this
+# long ago (the rates of the last days may not be published yet)
+ECB_AUTO_REFRESH_AGE = datetime.timedelta(hours=12)
+# the timeout in seconds of the download of the ECB history, as of the requests to the CBS api (see cpi_israel)
+ECB_REQUEST_TIMEOUT = 30
+
+
+def get_ecb_lines_from_zip(content):
+    with zipfile.ZipFile(io.BytesIO(content)) as zip_file:
+        csv_name = zip_file.namelist()[0]
+        return zip_file.read(csv_name).decode('utf-8').splitlines()
+
+
+class EcbRateStore:
+    """
+    Compact local snapshot of the ECB reference rates (EUR based), used instead of CurrencyConverter.
+    The rates are held in a single array of doubles with one row of consecutive days per currency, and saved to disk
+    as a json header line followed by the raw array, so loading a snapshot takes milliseconds and works offline.
+    Missing days inside the range of a currency (weekends, bank holidays) are filled by linear interpolation of the two
+    closest rates, the same as CurrencyConverter(fallback_on_missing_rate=True).
+    The snapshot is downloaded from the ECB only when it does not exist yet, when refresh() is called, or when a run
+    needs rates past its last day (see get_ecb_rate_store).
+    """
+
+    def __init__(self, rates_file=None):
+        if rates_file is None:
+            rates_file = os.path.join(get_cache_dir(), 'ecb_rates.bin')
+        self.rates_file = rates_file
+        self.first_ordinal = None
+        self.num_days = 0
+        self.currencies = []
+        self.currency_rows = {}
+        self.rates = array.array('d')
+        self.downloaded = None
+        if os.path.exists(self.rates_file):
+            self.load()
+
+    def load(self):
+        with open(self.rates_file, 'rb') as read_obj:
+            content = read_obj.read()
+        ind_header_end = content.index(b'\n')
+        header = json.loads(content[:ind_header_end])
+        self.first_ordinal = header['first_ordinal']
+        self.num_days = header['num_days']
+        self.currencies = header['currencies']
+        self.downloaded = header.get('downloaded')
+        self.currency_rows = {currency: ind for ind, currency in enumerate(self.currencies)}
+        self.rates = array.array('d')
+        self.rates.frombytes(content[ind_header_end + 1:])
+        if sys.byteorder != 'little':
+            self.rates.byteswap()
+        return
+
+    def save(self):
+        header = {'first_ordinal': self.first_ordinal, 'num_days': self.num_days, 'currencies': self.currencies,
+                  'downloaded': self.downloaded}
+        rates = array.array('d', self.rates)
+        if sys.byteorder != 'little':
+            rates.byteswap()
+        tmp_file = self.rates_file + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_file, 'wb') as write_obj:
+            write_obj.write(json.dumps(header).encode() + b'\n')
+            write_obj.write(rates.tobytes())
+        os.replace(tmp_file, self.rates_file)
+        return
+
+    def refresh(self, url=ECB_HISTORY_URL, timeout=ECB_REQUEST_TIMEOUT, stats=None):
+        """
+        download the full ECB history and rebuild the local snapshot.
+        the request is counted in stats (http_requests and ecb_downloads) if given.
+        """
+        import requests
+
+        if stats is not None:
+            stats.count('http_requests')
+            stats.count('ecb_downloads')
+        try:
+            response = requests.get(url, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            print('url:', url)
+            raise RateDataError(f"Failed to fetch data from url: {error!r}") from error
+        if response.status_code != 200:
+            print('url:', url)
+            raise RateDataError(f"Failed to fetch data from url: Status code {response.status_code}")
+        self.load_lines(get_ecb_lines_from_zip(response.content))
+        self.downloaded = datetime.datetime.now().isoformat()
+        self.save()
+        return
+
+    def load_lines(self, lines):
+        """
+        build the rates table from the lines of the ECB csv file: Date,USD,JPY,...
+        """
+        lines = iter(lines)
+        header = [currency.strip() for currency in next(lines).strip().split(',')[1:]]
+        known_rates = {currency: {} for currency in header if currency != ''}
+        for line in lines:
+            line = line.strip().split(',')
+            if line[0] == '':
+                continue
+            ordinal = datetime.date.fromisoformat(line[0]).toordinal()
+            for currency, rate in zip(header, line[1:]):
+                if currency != '' and rate not in ['', 'N/A']:
+                    known_rates[currency][ordinal] = float(rate)
+        known_rates = {currency: rates_dict for currency, rates_dict in known_rates.items() if len(rates_dict) > 0}
+
+        self.first_ordinal = min(min(rates_dict) for rates_dict in known_rates.values())
+        self.num_days = max(max(rates_dict) for rates_dict in known_rates.values()) - self.first_ordinal + 1
+        self.currencies = sorted(known_rates)
+        self.currency_rows = {currency: ind for ind, currency in enumerate(self.currencies)}
+        self.rates = array.array('d', [math.nan]) * (len(self.currencies) * self.num_days)
+        for currency in self.currencies:
+            self.fill_currency_row(currency, known_rates[currency])
+        return
+
+    def fill_currency_row(self, currency, rates_dict):
+        row_start = self.currency_rows[currency] * self.num_days - self.first_ordinal
+        ordinals = sorted(rates_dict)
+        for ind_known, ordinal in enumerate(ordinals):
+            rate = rates_dict[ordinal]
+            self.rates[row_start + ordinal] = rate
+            if ind_known + 1 < len(ordinals):
+                # linear interpolation of the missing days up to the next known rate
+                next_ordinal = ordinals[ind_known + 1]
+                next_rate = rates_dict[next_ordinal]
+                for missing_ordinal in range(ordinal + 1, next_ordinal):
+                    dist_before = missing_ordinal - ordinal
+                    dist_after = next_ordinal - missing_ordinal
+                    self.rates[row_start + missing_ordinal] = (rate * dist_after + next_rate * dist_before) \
+                                                              / (dist_before + dist_after)
+        return
+
+    def get_last_date(self):
+        if self.num_days == 0:
+            return None
+        return datetime.date.fromordinal(self.first_ordinal + self.num_days - 1)
+
+    def is_recent(self, now=None):
+        """
+        True if the snapshot was downloaded less than ECB_AUTO_REFRESH_AGE ago.
+        """
+        if self.downloaded is None:
+            return False
+        if now is None:
+            now = datetime.datetime.now()
+        return now - datetime.datetime.fromisoformat(self.downloaded) < ECB_AUTO_REFRESH_AGE
+
+    def get_rate(self, currency, date):
+        if currency == 'EUR':
+            return 1.0
+        if currency not in self.currency_rows:
+            raise ValueError(f"{currency} is not a supported currency")
+        ind_day = date.toordinal() - self.first_ordinal
+        rate = math.nan
+        if 0 <= ind_day < self.num_days:
+            rate = self.rates[self.currency_rows[currency] * self.num_days + ind_day]
+        if math.isnan(rate) and ind_day >= self.num_days:
+            raise RateDataError(f"{currency} has no rate for {date}, the local ECB snapshot ends on "
+                                f"{self.get_last_date()} (run with --refresh_rates to download the latest rates)")
+        if math.isnan(rate):
+            raise RateDataError(f"{currency} has no rate for {date}")
+        return rate
+
+    def convert(self, amount, currency, new_currency='EUR', date=None):
+        """
+        same interface as CurrencyConverter.convert, date can be a date or a datetime.
+        """
+        if date is None:
+            date = self.get_last_date()
+        elif isinstance(date, datetime.datetime):
+            date = date.date()
+        return float(amount) / self.get_rate(currency, date) * self.get_rate(new_currency, date)
+
+
+_default_ecb_rate_store = None
+_default_ecb_rate_store_lock = threading.Lock()
+
+
+def get_ecb_rate_store(refresh=False, last_date=None, stats=None):
+    """
+    the ECB rate store shared by the run, downloaded only if no local snapshot exists or refresh is requested.
+    if last_date (the last date the run needs rates for) is past the end of the snapshot, the snapshot is downloaded
+    again once, unless it is recent (see ECB_AUTO_REFRESH_AGE). a download is counted in stats if given.
+    """
+    global _default_ecb_rate_store
+    with _default_ecb_rate_store_lock:
+        if _default_ecb_rate_store is None:
+            _default_ecb_rate_store = EcbRateStore()
+        ecb_rate_store = _default_ecb_rate_store
+    if isinstance(last_date, datetime.datetime):
+        last_date = last_date.date()
+    is_outdated = last_date is not None and ecb_rate_store.num_days > 0 and not ecb_rate_store.is_recent() \
+        and last_date > ecb_rate_store.get_last_date()
+    if not (refresh or ecb_rate_store.num_days == 0 or is_outdated):
+        return ecb_rate_store
+    if is_outdated:
+        print('the local ECB snapshot ends on ' + str(ecb_rate_store.get_last_date())
+              + ', downloading the latest rates')
+    # the rates are downloaded into a new store without holding the lock, the other runs keep using the shared store
+    # meanwhile (and the runs that already hold it keep using it after the swap)
+    ecb_rate_store = EcbRateStore(ecb_rate_store.rates_file)
+    ecb_rate_store.refresh(stats=stats)
+    with _default_ecb_rate_store_lock:
+        _default_ecb_rate_store = ecb_rate_store
+    return ecb_rate_store
+
+
+def refresh_ecb_rate_store():
+    """
+    download the ECB rates into a new store and make it the shared one. runs that already hold the previous store keep
+    using it, so the rates can be refreshed while other threads are converting.
+    """
+    global _default_ecb_rate_store
+    ecb_rate_store = EcbRateStore()
+    ecb_rate_store.refresh()
+    with _default_ecb_rate_store_lock:
+        _default_ecb_rate_store = ecb_rate_store
+    return ecb_rate_store
+
+
+class FxLookupTable:
+    """
+    Per-run table of the conversion factors of (currency, date) keys to a single currency (ILS by default).
+    All the keys of a run are registered with add(), each distinct key is converted once in resolve(),
+    and every later get_factor() is served from the table, counting hits and misses.
+    """
+
+    def __init__(self, coin, new_currency='ILS'):
+        self.coin = coin
+        self.new_currency = new_currency
+        self.factors = {}
+        self.pending_keys = set()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, currency, date):
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        self.pending_keys.add((currency, date))
+        return
+
+    def resolve(self):
+        for key in self.pending_keys:
+            if key not in self.factors:
+                self.factors[key] = self.coin.convert(1, key[0], self.new_currency, date=key[1])
+                self.misses += 1
+        self.pending_keys = set()
+        return
+
+    def get_factor(self, currency, date):
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        key = (currency, date)
+        if key in self.factors:
+            self.hits += 1
+        else:
+            self.factors[key] = self.coin.convert(1, currency, self.new_currency, date=date)
+            self.misses += 1
+        return self.factors[key]
+
+    def get_stats(self):
+        return {'fx_distinct_keys': len(self.factors), 'fx_hits': self.hits, 'fx_misses': self.misses}
@@ -0,0 +1,92 @@
+class Trade:
+    """
+    a closing trade, the ClosedLot rows that follow it in the csv file are the lots it closes.
+    """
+    __slots__ = ('currency', 'ticker', 'datetime', 'quantity', 'price', 'fee')
+
+    def __init__(self, currency, ticker, datetime, quantity, price, fee):
+        self.currency = currency
+        self.ticker = ticker
+        self.datetime = datetime
+        self.quantity = quantity
+        self.price = price
+        self.fee = fee
+
+
+class ClosedLot:
+    """
+    a lot closed by a trade. the input fields are set when the csv file is read (the datetimes as strings, parsed once
+    the date format of the file is known), the computed fields (in the original currency and in ILS) are set by
+    tax_forms_functions.compute_closed_lot.
+    """
+    __slots__ = ('currency', 'ticker', 'asset_category', 'open_datetime', 'close_datetime', 'quantity',
+                 'open_price', 'close_price', 'close_fee',
+                 'close_value', 'open_value', 'profit',
+                 'open_currency_factor', 'close_currency_factor', 'currency_factor_ratio',
+                 'open_cpi', 'close_cpi', 'cpi_ratio',
+                 'open_value_ILS', 'open_value_ILS_adjusted_forex', 'open_value_ILS_adjusted_cpi',
+                 'close_value_ILS', 'profit_ILS_forex', 'profit_ILS_cpi')
+
+    # the fields set by tax_forms_functions.compute_closed_lot, in order
+    computed_fields = __slots__[9:]
+
+    def __init__(self, currency, ticker, asset_category, open_datetime, close_datetime, quantity,
+                 open_price, close_price, close_fee):
+        self.currency = currency
+        self.ticker = ticker
+        self.asset_category = asset_category
+        self.open_datetime = open_datetime
+        self.close_datetime = close_datetime
+        self.quantity = quantity
+        # the transaction-price for ClosedLot is the open price adjusted for fees:
+        self.open_price = open_price
+        # the transaction-price for the closing Trade is the close price NOT adjusted for fees:
+        self.close_price = close_price
+        self.close_fee = close_fee
+
+    def set_computed_values(self, values):
+        (self.close_value, self.open_value, self.profit,
+         self.open_currency_factor, self.close_currency_factor, self.currency_factor_ratio,
+         self.open_cpi, self.close_cpi, self.cpi_ratio,
+         self.open_value_ILS, self.open_value_ILS_adjusted_forex, self.open_value_ILS_adjusted_cpi,
+         self.close_value_ILS, self.profit_ILS_forex, self.profit_ILS_cpi) = values
+        return
+
+    @property
+    def position_type(self):
+        if self.quantity > 0:
+            return 'long'
+        else:
+            return 'short'
+
+    @property
+    def open_date(self):
+        return self.open_datetime.strftime("%d/%m/%Y")
+
+    @property
+    def close_date(self):
+        return self.close_datetime.strftime("%d/%m/%Y")
+
+
+class Dividend:
+    """
+    a dividend with its withholding tax (summed over all the matching rows of the csv file),
+    the ILS fields are set by tax_forms_functions.compute_dividends.
+    """
+    __slots__ = ('currency', 'ticker', 'datetime', 'amount', 'withholding_tax',
+                 'currency_factor', 'dividend_ILS', 'withholding_tax_ILS')
+
+    def __init__(self, currency, ticker, datetime, amount, withholding_tax=0):
+        self.currency = currency
+        self.ticker = ticker
+        self.datetime = datetime
+        self.amount = amount
+        self.withholding_tax = withholding_tax
+
+    @property
+    def dividend(self):
+        return self.amount
+
+    @property
+    def date(self):
+        return self.datetime.strftime("%d/%m/%Y")
@@ -0,0 +1,169 @@
+import csv
+import datetime
+import hashlib
+import json
+import os
+import re
+
+from aux_functions import get_cache_dir, TOOL_VERSION, SECTIONS_HEADER_COL_NAMES
+from cpi_israel import get_cpi_month_key
+from records import ClosedLot, Dividend
+
+CLOSED_LOT_KEY_FIELDS = ['currency', 'ticker', 'asset_category', 'open_datetime', 'close_datetime', 'quantity',
+                         'open_price', 'close_price', 'close_fee']
+DIVIDEND_KEY_FIELDS = ['currency', 'ticker', 'datetime', 'amount', 'withholding_tax']
+DIVIDEND_COMPUTED_FIELDS = ['currency_factor', 'dividend_ILS', 'withholding_tax_ILS']
+# the account of a Flex Query is read from the beginning of the xml file
+FLEX_ACCOUNT_ID_PATTERN = re.compile(rb'<FlexStatement\b[^>]*\baccountId="([^"]*)"')
+FLEX_ACCOUNT_ID_MAX_BYTES = 64 * 1024
+
+
+def get_file_hash(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as read_obj:
+        for chunk in iter(lambda: read_obj.read(1024 ** 2), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_statement_account_id(input_file):
+    """
+    the account of the statement: the Account field of the 'Account Information' section of the csv file, which comes
+    before the trades, or the accountId of the first FlexStatement of a Flex Query xml file. None if not found.
+    """
+    if input_file.endswith('.xml'):
+        with open(input_file, 'rb') as read_obj:
+            match = FLEX_ACCOUNT_ID_PATTERN.search(read_obj.read(FLEX_ACCOUNT_ID_MAX_BYTES))
+        return match.group(1).decode() if match is not None else None
+    with open(input_file, 'r') as read_obj:
+        for row in csv.reader(read_obj):
+            if len(row) >= 4 and row[0] == 'Account Information' and row[1] == 'Data' and row[2] == 'Account':
+                return row[3]
+            if len(row) > 0 and row[0] in SECTIONS_HEADER_COL_NAMES:
+                break
+    return None
+
+
+def get_record_key(record, key_fields):
+    """
+    the input values of a parsed record as a json list (datetimes in iso format), which identifies the record
+    independently of the date format and of the order of the rows in the csv file.
+    """
+    key_values = []
+    for field in key_fields:
+        value = getattr(record, field)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        key_values += [value]
+    return json.dumps(key_values)
+
+
+def get_record_from_key(record_class, key_fields, key):
+    values = json.loads(key)
+    for ind_field, field in enumerate(key_fields):
+        if 'datetime' in field:
+            values[ind_field] = datetime.datetime.fromisoformat(values[ind_field])
+    return record_class(*values)
+
+
+class StatementResultCache:
+    """
+    Persistent cache of the computed closed lots and dividends of a statement, kept in the cache dir and valid only for
+    the same TOOL_VERSION. The entry of a statement is keyed by its account (see get_statement_account_id), so any file
+    of the account (under any name, csv or Flex Query xml) finds the results of the last run of the account, or by the
+    content hash of the file if it has no account.
+    If the file is unchanged (same content hash) all the records are loaded without reading the file again.
+    Otherwise the file is parsed, and the records that appeared in the previous version of the statement (same input
+    values) take their computed values from the cache, so only new or changed rows are converted to ILS.
+    A closed lot is reused only if its CPI values were final when it was computed.
+    """
+
+    def __init__(self, csv_file, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(get_cache_dir(), 'results')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.file_hash = get_file_hash(csv_file)
+        account_id = get_statement_account_id(csv_file)
+        if account_id is not None:
+            entry_key = 'account:' + account_id
+        else:
+            entry_key = 'file:' + self.file_hash
+        self.cache_file = os.path.join(cache_dir, hashlib.sha256(entry_key.encode()).hexdigest()[:16] + '.json')
+        self.entry = None
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r') as read_obj:
+                entry = json.load(read_obj)
+            if entry['tool_version'] == TOOL_VERSION:
+                self.entry = entry
+
+    def is_complete(self):
+        """
+        True if the cached entry is of the same file content and all its records can be reused.
+        """
+        return self.entry is not None and self.entry['file_hash'] == self.file_hash \
+               and all(is_final for _, _, is_final in self.entry['closed_lots'])
+
+    def load_records(self):
+        closed_lots_list = []
+        for key, values, _ in self.entry['closed_lots']:
+            closed_lot = get_record_from_key(ClosedLot, CLOSED_LOT_KEY_FIELDS, key)
+            closed_lot.set_computed_values(values)
+            closed_lots_list.append(closed_lot)
+        dividends_list = []
+        for key, values in self.entry['dividends']:
+            dividend = get_record_from_key(Dividend, DIVIDEND_KEY_FIELDS, key)
+            for field, value in zip(DIVIDEND_COMPUTED_FIELDS, values):
+                setattr(dividend, field, value)
+            dividends_list.append(dividend)
+        return closed_lots_list, dividends_list
+
+    def restore_closed_lots(self, closed_lots_list):
+        """
+        set the computed values of the closed lots found in the cache, returns the closed lots left to compute.
+        """
+        if self.entry is None:
+            return closed_lots_list
+        cached_values = {key: values for key, values, is_final in self.entry['closed_lots'] if is_final}
+        new_closed_lots = []
+        for closed_lot in closed_lots_list:
+            key = get_record_key(closed_lot, CLOSED_LOT_KEY_FIELDS)
+            if key in cached_values:
+                closed_lot.set_computed_values(cached_values[key])
+            else:
+                new_closed_lots.append(closed_lot)
+        return new_closed_lots
+
+    def restore_dividends(self, dividends_list):
+        """
+        set the computed values of the dividends found in the cache, returns the dividends left to compute.
+        """
+        if self.entry is None:
+            return dividends_list
+        cached_values = {key: values for key, values in self.entry['dividends']}
+        new_dividends = []
+        for dividend in dividends_list:
+            key = get_record_key(dividend, DIVIDEND_KEY_FIELDS)
+            if key in cached_values:
+                for field, value in zip(DIVIDEND_COMPUTED_FIELDS, cached_values[key]):
+                    setattr(dividend, field, value)
+            else:
+                new_dividends.append(dividend)
+        return new_dividends
+
+    def save(self, closed_lots_list, dividends_list, cpi_store):
+        closed_lots_entries = []
+        for closed_lot in closed_lots_list:
+            is_final = cpi_store.is_final(get_cpi_month_key(closed_lot.open_datetime)) \
+                       and cpi_store.is_final(get_cpi_month_key(closed_lot.close_datetime))
+            closed_lots_entries += [(get_record_key(closed_lot, CLOSED_LOT_KEY_FIELDS),
+                                     [getattr(closed_lot, field) for field in ClosedLot.computed_fields], is_final)]
+        dividends_entries = [(get_record_key(dividend, DIVIDEND_KEY_FIELDS),
+                              [getattr(dividend, field) for field in DIVIDEND_COMPUTED_FIELDS])
+                             for dividend in dividends_list]
+        self.entry = {'tool_version': TOOL_VERSION, 'file_hash': self.file_hash,
+                      'closed_lots': closed_lots_entries, 'dividends': dividends_entries}
+        tmp_file = self.cache_file + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_file, 'w') as write_obj:
+            json.dump(self.entry, write_obj)
+        os.replace(tmp_file, self.cache_file)
+        return
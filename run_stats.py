@@ -0,0 +1,70 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+
+
+def get_peak_memory_mb():
+    """
+    the peak resident memory of the process in MB, or None where it is not available (the resource module is unix only).
+    it is the peak of the whole process since it started, not of a single run (e.g. of a batch worker or a server).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    if sys.platform == 'darwin':
+        return max_rss / 1024 ** 2
+    return max_rss / 1024
+
+
+class RunStats:
+    """
+    Wall times of the stages of a run and counters of its work, collected with little overhead so it can always be on.
+    A stage can be entered several times (e.g. FX lookups of the trades and then of the dividends), its times are summed.
+    Counters can be added to from several threads (e.g. the requests of the concurrent CPI fetches).
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stage_seconds = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, stage_name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage_name] = self.stage_seconds.get(stage_name, 0) + time.perf_counter() - start_time
+
+    def count(self, counter_name, value=1):
+        with self.lock:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + value
+        return
+
+    def get_stats(self):
+        return {'total_seconds': time.perf_counter() - self.start_time,
+                'stage_seconds': dict(self.stage_seconds),
+                'counters': dict(self.counters),
+                'process_peak_memory_mb': get_peak_memory_mb()}
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print('total: %.3f s' % stats['total_seconds'])
+        for stage_name, seconds in stats['stage_seconds'].items():
+            print('  ' + stage_name + ': %.3f s' % seconds)
+        for counter_name, value in stats['counters'].items():
+            print('  ' + counter_name + ': ' + str(value))
+        if stats['process_peak_memory_mb'] is not None:
+            print('  peak memory of the process: %.1f MB' % stats['process_peak_memory_mb'])
+        return
+
+    def save(self, json_file):
+        with open(json_file, 'w') as write_obj:
+            json.dump(self.get_stats(), write_obj, indent=1)
+        return
@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import operator
+import pickle
+import tempfile
+
+from aux_functions import iter_statement_rows, infer_date_slash_format, get_date_parser
+from cpi_israel import get_default_cpi_store
+from fx_rates import get_ecb_rate_store, FxLookupTable
+from run_stats import RunStats
+from tax_forms_functions import get_trades_section_handler, parse_closed_lots_dates, prefetch_closed_lots_rates, \
+    compute_closed_lots_values, get_dividends_section_handler, merge_dividend_events, compute_dividends, \
+    get_tax_form_workbook, export_tax_tables
+
+# the number of closed lots converted to ILS together, and the number of closed lots held in memory for sorting by
+# closing date before they are spilled to a temporary file
+COMPUTE_CHUNK_SIZE = 10000
+MAX_LOTS_IN_MEMORY = 200000
+
+get_close_datetime = operator.attrgetter('close_datetime')
+
+
+def iter_raw_closed_lots(csv_file):
+    """
+    iterate over the closed lots of the csv file as they are read, with their datetimes still as strings.
+    """
+    closed_lots_buffer = []
+    handle_trades_row = get_trades_section_handler(closed_lots_buffer)
+    for _, row, col_names in iter_statement_rows(csv_file, ['Trades']):
+        handle_trades_row(row, col_names)
+        if len(closed_lots_buffer) > 0:
+            yield from closed_lots_buffer
+            closed_lots_buffer.clear()
+    return
+
+
+def iter_dividend_events(csv_file):
+    dividend_events = []
+    handle_dividends_row = get_dividends_section_handler(dividend_events)
+    for _, row, col_names in iter_statement_rows(csv_file, ['Dividends', 'Withholding Tax']):
+        handle_dividends_row(row, col_names)
+        if len(dividend_events) > 0:
+            yield from dividend_events
+            dividend_events.clear()
+    return
+
+
+def scan_date_slash_format(csv_file):
+    """
+    infer the date format of the file in a pre-scan, from the same dates and in the same order as
+    tax_forms_functions.get_file_date_parser, without keeping the records.
+    """
+    dividend_date_strings = (event[2] for event in iter_dividend_events(csv_file))
+    closed_lot_date_strings = (date_string for closed_lot in iter_raw_closed_lots(csv_file)
+                               for date_string in (closed_lot.open_datetime, closed_lot.close_datetime))
+    return infer_date_slash_format(itertools.chain(dividend_date_strings, closed_lot_date_strings))
+
+
+def iter_closed_lots(csv_file, date_slash_format=None):
+    """
+    iterate over the closed lots of the csv file (before conversion to ILS) as they are read.
+    unless date_slash_format is given, the file is scanned once before to infer it.
+    """
+    if date_slash_format is None:
+        date_slash_format = scan_date_slash_format(csv_file)
+    parse_date = get_date_parser(date_slash_format)
+    for closed_lot in iter_raw_closed_lots(csv_file):
+        parse_closed_lots_dates([closed_lot], parse_date)
+        yield closed_lot
+    return
+
+
+def iter_dividends(csv_file, date_slash_format=None, stats=None):
+    """
+    iterate over the dividends of the csv file (before conversion to ILS), with their withholding tax.
+    the withholding tax rows follow the dividends in the file, so the dividends are yielded once the file is read.
+    unless date_slash_format is given, the file is scanned once before to infer it.
+    """
+    if date_slash_format is None:
+        date_slash_format = scan_date_slash_format(csv_file)
+    yield from merge_dividend_events(iter_dividend_events(csv_file), get_date_parser(date_slash_format), stats=stats)
+    return
+
+
+def iter_computed_closed_lots(closed_lots, fx_table, cpi_store, chunk_size=COMPUTE_CHUNK_SIZE, engine='scalar',
+                              stats=None):
+    """
+    convert the closed lots to ILS (as tax_forms_functions.compute_closed_lots, without sorting) in chunks of
+    chunk_size lots. the reading of every chunk is timed as the parse stage.
+    """
+    if stats is None:
+        stats = RunStats()
+    closed_lots = iter(closed_lots)
+    while True:
+        with stats.stage('parse'):
+            closed_lots_chunk = list(itertools.islice(closed_lots, chunk_size))
+        if len(closed_lots_chunk) == 0:
+            return
+        prefetch_closed_lots_rates(closed_lots_chunk, fx_table, cpi_store, stats)
+        compute_closed_lots_values(closed_lots_chunk, fx_table, cpi_store, engine, stats)
+        yield from closed_lots_chunk
+
+
+def iter_spilled_run(run_file):
+    run_file.seek(0)
+    while True:
+        try:
+            yield pickle.load(run_file)
+        except EOFError:
+            return
+
+
+class SortedClosedLots:
+    """
+    The closed lots sorted by closing date, as required in form 1325, holding at most max_lots_in_memory lots in
+    memory: the lots are read once when the object is created, every max_lots_in_memory lots are sorted and spilled to
+    a temporary file (in spill_dir), and every iteration merges the sorted runs back from disk, so the lots can be
+    iterated several times (e.g. for the totals and then for the rows of the workbook). lots with the same closing
+    date keep their order in the file, the same as tax_forms_functions.get_inds_sorted_close_dates.
+    Use it as a context manager, or call close(), to remove the temporary files.
+    """
+
+    def __init__(self, closed_lots, max_lots_in_memory=MAX_LOTS_IN_MEMORY, spill_dir=None, stats=None):
+        if stats is None:
+            stats = RunStats()
+        self.run_files = []
+        self.closed_lots_buffer = []
+        try:
+            for closed_lot in closed_lots:
+                self.closed_lots_buffer.append(closed_lot)
+                if len(self.closed_lots_buffer) >= max_lots_in_memory:
+                    with stats.stage('sort'):
+                        self.spill_buffer(spill_dir)
+            with stats.stage('sort'):
+                self.closed_lots_buffer.sort(key=get_close_datetime)
+        except BaseException:
+            self.close()
+            raise
+        stats.count('spilled_runs', len(self.run_files))
+
+    def spill_buffer(self, spill_dir):
+        self.closed_lots_buffer.sort(key=get_close_datetime)
+        run_file = tempfile.TemporaryFile(dir=spill_dir)
+        self.run_files.append(run_file)
+        for closed_lot in self.closed_lots_buffer:
+            pickle.dump(closed_lot, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.closed_lots_buffer = []
+        return
+
+    def __iter__(self):
+        if len(self.run_files) == 0:
+            return iter(self.closed_lots_buffer)
+        # the runs are merged in their order in the file, heapq.merge keeps the order of equal dates
+        return heapq.merge(*[iter_spilled_run(run_file) for run_file in self.run_files], self.closed_lots_buffer,
+                           key=get_close_datetime)
+
+    def close(self):
+        for run_file in self.run_files:
+            run_file.close()
+        self.run_files = []
+        self.closed_lots_buffer = []
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def iter_sorted_by_close_date(closed_lots, max_lots_in_memory=MAX_LOTS_IN_MEMORY, spill_dir=None, stats=None):
+    """
+    iterate once over the closed lots sorted by closing date (see SortedClosedLots).
+    """
+    with SortedClosedLots(closed_lots, max_lots_in_memory=max_lots_in_memory, spill_dir=spill_dir,
+                          stats=stats) as sorted_closed_lots:
+        yield from sorted_closed_lots
+    return
+
+
+def count_records(records, stats, counter_name):
+    for record in records:
+        stats.count(counter_name)
+        yield record
+    return
+
+
+def generate_tax_forms_streaming(file_dir, csv_file_name, verbosity=0, refresh_rates=False, engine='scalar',
+                                 date_slash_format=None, max_lots_in_memory=MAX_LOTS_IN_MEMORY, spill_dir=None,
+                                 export_formats=(), profile=False, profile_file=None):
+    """
+    the same tax forms as tax_forms_functions.generate_tax_forms, for statements too large to hold in memory:
+    the closed lots are read and converted to ILS in chunks, sorted by closing date with a spill-to-disk merge sort,
+    and written to a write-only workbook row by row (see tax_forms_functions.get_tax_form_workbook), so the memory of the lots
+    is bounded by max_lots_in_memory. (the dividends are still held in memory.)
+    export_formats can only include 'csv', whose table is written row by row. the result cache is not used.
+    returns the stats of the run, which are printed if profile=True and written to profile_file as json.
+    """
+    if any(export_format != 'csv' for export_format in export_formats):
+        raise ValueError('only csv tables can be exported from a streaming run', export_formats)
+    stats = RunStats()
+    for counter_name in ['http_requests', 'ecb_downloads', 'cpi_hits', 'cpi_misses']:
+        stats.count(counter_name, 0)
+    csv_file = file_dir + '/' + csv_file_name + '.csv'
+    with stats.stage('fx'):
+        fx_table = FxLookupTable(get_ecb_rate_store(refresh=refresh_rates, stats=stats))
+    with stats.stage('cpi'):
+        cpi_store = get_default_cpi_store()
+    with stats.stage('parse'):
+        if date_slash_format is None:
+            date_slash_format = scan_date_slash_format(csv_file)
+        dividends_list = list(iter_dividends(csv_file, date_slash_format, stats=stats))
+    stats.count('dividends', len(dividends_list))
+    compute_dividends(dividends_list, fx_table, stats=stats)
+
+    # the lots flow from the csv file through the computation to the sorted runs on disk, their stages are timed
+    # chunk by chunk, and then they are merged back for the totals and the rows of the workbook
+    closed_lots = count_records(iter_closed_lots(csv_file, date_slash_format), stats, 'closed_lots')
+    with SortedClosedLots(iter_computed_closed_lots(closed_lots, fx_table, cpi_store, engine=engine, stats=stats),
+                          max_lots_in_memory=max_lots_in_memory, spill_dir=spill_dir,
+                          stats=stats) as sorted_closed_lots:
+        with stats.stage('excel_write'):
+            xfile = get_tax_form_workbook(sorted_closed_lots, dividends_list)
+        with stats.stage('save'):
+            xfile.save(file_dir + '/tax_forms_' + csv_file_name + '.xlsx')
+        for export_format in export_formats:
+            with stats.stage('export'):
+                export_tax_tables(file_dir, csv_file_name, sorted_closed_lots, dividends_list,
+                                  export_format=export_format)
+
+    for counter_name, value in fx_table.get_stats().items():
+        stats.count(counter_name, value)
+    if verbosity == 1:
+        print('FX lookups:', fx_table.get_stats())
+    print('Finished generating tax forms.')
+    if profile:
+        stats.print_stats()
+    if profile_file is not None:
+        stats.save(profile_file)
+    return stats.get_stats()
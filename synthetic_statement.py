@@ -0,0 +1,191 @@
+import argparse
+import csv
+import datetime
+import json
+import random
+
+from fx_rates import EcbRateStore
+
+TRADES_HEADER = ['Trades', 'Header', 'DataDiscriminator', 'Asset Category', 'Currency', 'Symbol', 'Date/Time',
+                 'Quantity', 'T. Price', 'C. Price', 'Proceeds', 'Comm/Fee', 'Basis', 'Realized P/L', 'MTM P/L', 'Code']
+DIVIDENDS_HEADER = ['Dividends', 'Header', 'Currency', 'Date', 'Description', 'Amount']
+WITHHOLDING_TAX_HEADER = ['Withholding Tax', 'Header', 'Currency', 'Date', 'Description', 'Amount', 'Code']
+
+STOCK_TICKERS = ['AAPL', 'MSFT', 'NVDA', 'AMZN', 'GOOGL', 'META', 'TSLA', 'JPM', 'XOM', 'VTI', 'QQQ', 'SPY', 'BRK B',
+                 'KO', 'PEP', 'O', 'JEPI', 'SCHD', 'VWRA', 'CSPX']
+
+# number of years before the first trade year in which the closed lots may have been opened
+MAX_HOLDING_YEARS = 2
+
+
+def get_random_datetime(rng, years):
+    first_date = datetime.datetime(min(years), 1, 1)
+    num_days = (datetime.datetime(max(years), 12, 31) - first_date).days
+    return first_date + datetime.timedelta(days=rng.randint(0, num_days), seconds=rng.randint(9 * 3600, 17 * 3600))
+
+
+def format_statement_date(date_input, date_format, with_time, rng):
+    """
+    the date forms of the IB csv file, 'mixed' picks one of them at random for every row (as IB does).
+    """
+    if date_format == 'mixed':
+        date_format = rng.choice(['iso', 'normal'])
+    if date_format == 'iso':
+        if with_time:
+            return date_input.strftime('%Y-%m-%d, %H:%M:%S')
+        return date_input.strftime('%Y-%m-%d')
+    elif date_format == 'normal':
+        return date_input.strftime('%d/%m/%Y')
+    elif date_format == 'USA':
+        return date_input.strftime('%m/%d/%Y')
+    else:
+        raise ValueError('invalid date_format', date_format)
+
+
+def format_quantity(quantity):
+    # IB writes large quantities with a thousands separator
+    return '{:,}'.format(quantity)
+
+
+def get_trade_rows(rng, asset_category, ticker, currency, years, max_lots_per_trade, date_format):
+    close_datetime = get_random_datetime(rng, years)
+    position_sign = rng.choice([1, 1, 1, -1])
+    lot_quantities = [position_sign * rng.randint(1, 10 if asset_category != 'Stocks' else 2000)
+                      for _ in range(rng.randint(1, max_lots_per_trade))]
+    close_price = round(rng.uniform(1, 500), 2)
+    fee = round(rng.uniform(0.35, 5), 2)
+    rows = [['Trades', 'Data', 'Trade', asset_category, currency, ticker,
+             format_statement_date(close_datetime, date_format, True, rng), format_quantity(-sum(lot_quantities)),
+             str(close_price), str(close_price), '0', str(-fee), '0', '0', '0', 'C']]
+    for lot_quantity in lot_quantities:
+        open_datetime = close_datetime - datetime.timedelta(days=rng.randint(1, 365 * MAX_HOLDING_YEARS))
+        rows += [['Trades', 'Data', 'ClosedLot', asset_category, currency, ticker,
+                  format_statement_date(open_datetime, date_format, False, rng), format_quantity(lot_quantity),
+                  str(round(close_price * rng.uniform(0.5, 1.5), 4)), '', '', '', '', '', '', 'O']]
+    return rows
+
+
+def write_synthetic_statement(csv_file, num_stock_trades=1000, num_option_trades=200, max_lots_per_trade=3,
+                              num_dividends=500, withholding_fraction=0.8, currencies=('USD',), date_format='mixed',
+                              years=(2023,), seed=0):
+    """
+    write a realistic IB activity statement csv file: Trades (stocks and options, each closing Trade followed by its
+    ClosedLot rows), Dividends and Withholding Tax sections, with their SubTotal/Total rows.
+    date_format is 'iso', 'normal', 'USA' or 'mixed'.
+    returns the number of rows of each kind.
+    """
+    rng = random.Random(seed)
+    counts = {'trades': 0, 'closed_lots': 0, 'dividends': 0, 'withholding_tax': 0}
+    rows = [['Statement', 'Header', 'Field Name', 'Field Value'],
+            ['Statement', 'Data', 'Title', 'Activity Statement'],
+            TRADES_HEADER]
+
+    for asset_category, num_trades in [('Stocks', num_stock_trades), ('Equity and Index Options', num_option_trades)]:
+        for currency in currencies:
+            for ind_trade in range(num_trades // len(currencies)):
+                ticker = rng.choice(STOCK_TICKERS)
+                if asset_category == 'Equity and Index Options':
+                    ticker += ' ' + rng.choice(['19JAN24', '15MAR24', '21JUN24']) + ' ' + str(rng.randint(5, 60) * 5) \
+                              + ' ' + rng.choice(['C', 'P'])
+                trade_rows = get_trade_rows(rng, asset_category, ticker, currency, years, max_lots_per_trade,
+                                            date_format)
+                rows += trade_rows
+                counts['trades'] += 1
+                counts['closed_lots'] += len(trade_rows) - 1
+            rows += [['Trades', 'SubTotal', '', asset_category, currency, '', '', '', '', '', '0', '0', '0', '0', '0',
+                      '']]
+    rows += [['Trades', 'Total', '', '', '', '', '', '', '', '', '0', '0', '0', '0', '0', '']]
+
+    dividend_rows = [DIVIDENDS_HEADER]
+    withholding_tax_rows = [WITHHOLDING_TAX_HEADER]
+    for ind_dividend in range(num_dividends):
+        currency = currencies[ind_dividend % len(currencies)]
+        ticker = rng.choice(STOCK_TICKERS)
+        pay_date = format_statement_date(get_random_datetime(rng, years), date_format, False, rng)
+        amount = round(rng.uniform(0.5, 300), 2)
+        description = ticker + '(US0000000000) Cash Dividend ' + currency + ' 0.25 per Share (Ordinary Dividend)'
+        dividend_rows += [['Dividends', 'Data', currency, pay_date, description, str(amount)]]
+        counts['dividends'] += 1
+        if rng.random() < withholding_fraction:
+            withholding_tax_rows += [['Withholding Tax', 'Data', currency, pay_date, description + ' - US Tax',
+                                      str(round(-0.25 * amount, 2)), '']]
+            counts['withholding_tax'] += 1
+    for currency in currencies:
+        dividend_rows += [['Dividends', 'Data', 'Total in ' + currency, '', '', '0']]
+        withholding_tax_rows += [['Withholding Tax', 'Data', 'Total in ' + currency, '', '', '0', '']]
+    rows += dividend_rows + withholding_tax_rows
+
+    with open(csv_file, 'w', newline='') as write_obj:
+        csv.writer(write_obj).writerows(rows)
+    return counts
+
+
+def get_fixture_months(years):
+    first_year = min(years) - MAX_HOLDING_YEARS - 1
+    return ['%04d-%02d' % (year, month) for year in range(first_year, max(years) + 1) for month in range(1, 13)]
+
+
+def write_fx_fixture(rates_file, currencies=('USD',), years=(2023,), seed=0):
+    """
+    write a local ECB rate snapshot (see fx_rates.EcbRateStore) with synthetic daily rates of the currencies and ILS,
+    with weekends missing as in the ECB data, covering the years, the holding period before them and the first month
+    after them (so the last days of the last year are interpolated and not past the end of the data).
+    """
+    rng = random.Random(seed)
+    fx_currencies = sorted(set(currencies) - {'EUR'} | {'ILS'})
+    first_date = datetime.date(min(years) - MAX_HOLDING_YEARS - 1, 1, 1)
+    last_date = datetime.date(max(years) + 1, 1, 31)
+    rates = {currency: rng.uniform(0.5, 5) for currency in fx_currencies}
+    lines = ['Date,' + ','.join(fx_currencies) + ',']
+    date_input = first_date
+    while date_input <= last_date:
+        if date_input.weekday() < 5:
+            for currency in fx_currencies:
+                rates[currency] *= rng.uniform(0.99, 1.01)
+            lines += [date_input.isoformat() + ',' + ','.join('%.4f' % rates[currency] for currency in fx_currencies)
+                      + ',']
+        date_input += datetime.timedelta(days=1)
+    ecb_rate_store = EcbRateStore(rates_file)
+    ecb_rate_store.load_lines(lines)
+    ecb_rate_store.save()
+    return ecb_rate_store
+
+
+def write_cpi_fixture(fixture_file, years=(2023,), seed=0):
+    """
+    write a CPI fixture file {'YYYY-MM': value} (see cpi_israel.get_cpi_fixture_fetcher) covering the years
+    and the holding period before them.
+    """
+    rng = random.Random(seed)
+    cpi_value = 200.0
+    fixture_values = {}
+    for month_key in get_fixture_months(years):
+        cpi_value = round(cpi_value * rng.uniform(0.998, 1.006), 1)
+        fixture_values[month_key] = cpi_value
+    with open(fixture_file, 'w') as write_obj:
+        json.dump(fixture_values, write_obj, indent=1)
+    return fixture_values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic IB activity statement csv file")
+    parser.add_argument("-csv_file", "--csv_file", type=str, required=True, help="path of the csv file to write")
+    parser.add_argument("-stock_trades", "--stock_trades", default=1000, type=int, help="number of closing stock trades")
+    parser.add_argument("-option_trades", "--option_trades", default=200, type=int,
+                        help="number of closing option trades")
+    parser.add_argument("-lots_per_trade", "--lots_per_trade", default=3, type=int,
+                        help="maximal number of ClosedLot rows per closing trade")
+    parser.add_argument("-dividends", "--dividends", default=500, type=int, help="number of dividend rows")
+    parser.add_argument("-withholding_fraction", "--withholding_fraction", default=0.8, type=float,
+                        help="fraction of the dividends with a withholding tax row")
+    parser.add_argument("-currencies", "--currencies", default=['USD'], nargs='+', type=str, help="trade currencies")
+    parser.add_argument("-date_format", "--date_format", default='mixed', type=str,
+                        choices=['iso', 'normal', 'USA', 'mixed'], help="form of the dates in the file")
+    parser.add_argument("-years", "--years", default=[2023], nargs='+', type=int, help="years of the trades")
+    parser.add_argument("-seed", "--seed", default=0, type=int, help="random seed")
+    args = parser.parse_args()
+    print(write_synthetic_statement(args.csv_file, num_stock_trades=args.stock_trades,
+                                    num_option_trades=args.option_trades, max_lots_per_trade=args.lots_per_trade,
+                                    num_dividends=args.dividends, withholding_fraction=args.withholding_fraction,
+                                    currencies=args.currencies, date_format=args.date_format, years=args.years,
+                                    seed=args.seed))
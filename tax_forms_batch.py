@@ -0,0 +1,156 @@
+import concurrent.futures
+import datetime
+import glob
+import json
+import os
+import time
+import traceback
+
+from aux_functions import validate_statement
+from cpi_israel import get_default_cpi_store
+from fx_rates import get_ecb_rate_store
+from tax_forms_functions import generate_tax_forms, EXPORT_TABLE_NAMES
+
+
+def is_export_table_file(csv_file):
+    """
+    True for the csv table exports of a previous run (see tax_forms_functions.export_tax_tables), which are written
+    next to the statements and are not statements themselves.
+    """
+    file_name = os.path.basename(csv_file)
+    return file_name.startswith('tax_forms_') \
+           and any(file_name.endswith('_' + table_name + '.csv') for table_name in EXPORT_TABLE_NAMES)
+
+
+def get_batch_csv_files(batch_input):
+    """
+    the csv files of a batch, given as a directory (all the csv files in it), a manifest file (a text file with one
+    csv path per line, relative paths are relative to the manifest), a single csv file or a glob pattern.
+    the table exports of previous runs are left out of directories and glob patterns.
+    """
+    if os.path.isdir(batch_input):
+        csv_files = glob.glob(os.path.join(batch_input, '*.csv'))
+        csv_files = [csv_file for csv_file in csv_files if not is_export_table_file(csv_file)]
+    elif os.path.isfile(batch_input) and batch_input.endswith('.csv'):
+        csv_files = [batch_input]
+    elif os.path.isfile(batch_input):
+        manifest_dir = os.path.dirname(os.path.abspath(batch_input))
+        csv_files = []
+        with open(batch_input, 'r') as read_obj:
+            for line in read_obj:
+                line = line.strip()
+                if line != '' and not line.startswith('#'):
+                    csv_files += [os.path.join(manifest_dir, line)]
+    else:
+        csv_files = [csv_file for csv_file in glob.glob(batch_input) if not is_export_table_file(csv_file)]
+    return sorted(csv_files)
+
+
+def init_batch_worker():
+    """
+    load the FX and CPI stores once per worker process. when workers are forked they are inherited already loaded
+    from the parent process, otherwise they are read from the local snapshots on disk.
+    """
+    get_ecb_rate_store()
+    get_default_cpi_store()
+    return
+
+
+def prefetch_batch_rates(csv_files, refresh_rates=False):
+    """
+    load the FX snapshot and fetch the CPI months of all the statements of the batch once in the parent process,
+    before the workers start, so the workers find them in the stores (inherited or saved to disk) instead of
+    downloading the same data each. the FX snapshot is downloaded again if refresh_rates=True or if a statement is
+    dated past its end (see fx_rates.get_ecb_rate_store).
+    the months and the last dates are collected by aux_functions.validate_statement, without computing anything.
+    a file that cannot be read is skipped here, its error is reported by its own run.
+    """
+    cpi_dates = []
+    last_date = None
+    for csv_file in csv_files:
+        try:
+            report = validate_statement(csv_file)
+        except Exception:
+            continue
+        cpi_dates += [datetime.date(int(month_key[:4]), int(month_key[5:]), 1) for month_key in report['cpi_months']]
+        if report['last_date'] is not None:
+            file_last_date = datetime.date.fromisoformat(report['last_date'])
+            last_date = file_last_date if last_date is None else max(last_date, file_last_date)
+    get_ecb_rate_store(refresh=refresh_rates, last_date=last_date)
+    try:
+        get_default_cpi_store().prefetch(cpi_dates)
+    except Exception as error:
+        # the workers fetch the months they are missing, and report their failures per file
+        print('prefetch of the CPI values of the batch failed:', repr(error))
+    return
+
+
+def generate_tax_forms_report(csv_file, verbosity=0, engine='scalar', export_formats=(), use_result_cache=True):
+    """
+    run generate_tax_forms for a single csv file of a batch, and report the outcome (with the stats of the run)
+    instead of raising.
+    """
+    report = {'csv_file': csv_file}
+    start_time = time.time()
+    try:
+        file_dir = os.path.dirname(os.path.abspath(csv_file))
+        csv_file_name = os.path.splitext(os.path.basename(csv_file))[0]
+        report['stats'] = generate_tax_forms(file_dir, csv_file_name, verbosity=verbosity, engine=engine,
+                                             export_formats=export_formats, use_result_cache=use_result_cache)
+        report['status'] = 'ok'
+        report['output_file'] = file_dir + '/tax_forms_' + csv_file_name + '.xlsx'
+    except Exception as error:
+        report['status'] = 'failed'
+        report['error'] = repr(error)
+        report['traceback'] = traceback.format_exc()
+    report['seconds'] = time.time() - start_time
+    return report
+
+
+def generate_tax_forms_batch(batch_input, num_workers=None, verbosity=0, refresh_rates=False, engine='scalar',
+                             export_formats=(), report_file=None, use_result_cache=True, validate_only=False):
+    """
+    generate the tax forms of many statements on a pool of worker processes.
+    the FX and CPI stores are loaded once in the parent process, where the FX snapshot is refreshed if needed and the
+    CPI months of all the statements are fetched (see prefetch_batch_rates), and shared by the workers.
+    a failure of one statement is recorded in its report and does not stop the batch.
+    with validate_only=True every statement is only checked by aux_functions.validate_statement (no network access
+    and no Excel files), and its report is the report of the check.
+    returns the list of reports, one per csv file, and optionally writes it to report_file as json.
+    """
+    csv_files = get_batch_csv_files(batch_input)
+    if len(csv_files) == 0:
+        print('no csv files found for batch input:', batch_input)
+        return []
+
+    if validate_only:
+        reports = [validate_statement(csv_file) for csv_file in csv_files]
+        print(json.dumps(reports, indent=1))
+        if report_file is not None:
+            with open(report_file, 'w') as write_obj:
+                json.dump(reports, write_obj, indent=1)
+        return reports
+
+    prefetch_batch_rates(csv_files, refresh_rates=refresh_rates)
+
+    if num_workers == 1:
+        reports = [generate_tax_forms_report(csv_file, verbosity=verbosity, engine=engine,
+                                             export_formats=export_formats, use_result_cache=use_result_cache)
+                   for csv_file in csv_files]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=init_batch_worker) as pool:
+            futures = [pool.submit(generate_tax_forms_report, csv_file, verbosity=verbosity, engine=engine,
+                                   export_formats=export_formats, use_result_cache=use_result_cache)
+                       for csv_file in csv_files]
+            reports = [future.result() for future in futures]
+
+    num_failed = len([report for report in reports if report['status'] == 'failed'])
+    for report in reports:
+        if report['status'] == 'failed':
+            print('failed:', report['csv_file'], report['error'])
+    print('Finished batch: ' + str(len(reports) - num_failed) + ' succeeded, ' + str(num_failed) + ' failed.')
+
+    if report_file is not None:
+        with open(report_file, 'w') as write_obj:
+            json.dump(reports, write_obj, indent=1)
+    return reports
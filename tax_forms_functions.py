@@ -1,344 +1,800 @@
 import argparse
 import copy
 import csv
-import datetime
+import json
+import operator
 import os
 
-import openpyxl
-from currency_converter import CurrencyConverter, ECB_URL
-from cpi_israel import get_israel_cpi_value
-from aux_functions import get_date_format, get_trades_col_names, get_dividends_col_names
+from cpi_israel import get_default_cpi_store
+from fx_rates import get_ecb_rate_store, FxLookupTable
+from aux_functions import infer_date_slash_format, get_date_parser, read_statement_sections, validate_statement, \
+    TRADES_ASSET_CATEGORIES
+from records import Trade, ClosedLot, Dividend
+from result_cache import StatementResultCache
+from run_stats import RunStats
 
-def extract_trades_data_from_csv(file_dir, csv_file_name, verbosity=0, date_slash_format='normal'):
+def get_trades_section_handler(closed_lots_list):
     """
-    read the csv output file from IB and extract the necessary data for closing transactions and dividends
+    returns the handler of the 'Trades' rows of the csv file, that appends the closed lots (in the original currency)
+    to closed_lots_list. every ClosedLot row is matched with the closing Trade row that precedes it.
+    the open and close datetimes are kept as strings until parse_closed_lots_dates.
     """
-    csv_file = file_dir + '/' + csv_file_name + '.csv'
-    coin = CurrencyConverter(ECB_URL, fallback_on_missing_rate=True)  # using the ECB database
-
-    # csv file column definitions
-    col_names = get_trades_col_names(csv_file)
-
-    if len(col_names) > 0:
-        # open file in read mode
-        with open(csv_file, 'r') as read_obj:
-            csv_reader = csv.reader(read_obj)
-
-            previous_trade_dict = None
-            closed_lots_list = []
-            closed_lots_datetime_list = []
-
-            for row in csv_reader:
-                if verbosity == 1:
-                    print(row)
-
-                # skip irrelevant rows
-                if row[col_names['main']] == 'Trades' and row[col_names['header']] == 'Data' and row[col_names['asset_category']] in ['Stocks', 'Equity and Index Options']:
-                    if 'Trade' in row[col_names['trade_type']] or 'ClosedLot' in row[col_names['trade_type']]:
-                        trade_dict = {}
-                        trade_dict['trade_type'] = row[col_names['trade_type']]
-                        trade_dict['currency'] = row[col_names['currency']]
-                        trade_dict['ticker'] = row[col_names['ticker']]
-                        datetime_string = row[col_names['datetime']]
-                        date_format = get_date_format(datetime_string, date_slash_format=date_slash_format)
-                        trade_dict['datetime'] = datetime.datetime.strptime(datetime_string, date_format)
-                        trade_dict['quantity'] = float(
-                            row[col_names['quantity']].replace(',', ''))  # remove comma from strings of quantities
-                        trade_dict['price'] = float(row[col_names['price']])
-                        if row[col_names['trade_type']] == 'Trade':
-                            trade_dict['fee'] = abs(float(row[col_names['fee']]))
-                        if 'Trade' in trade_dict['trade_type']:
-                            previous_trade_dict = copy.deepcopy(trade_dict)
-                        elif 'ClosedLot' in trade_dict['trade_type']:
-                            closed_lot_dict = {}
-                            closed_lot_dict['currency'] = trade_dict['currency']
-                            closed_lot_dict['ticker'] = trade_dict['ticker']
-                            closed_lot_dict['close_datetime'] = previous_trade_dict['datetime']
-                            closed_lot_dict['close_date'] = closed_lot_dict['close_datetime'].strftime("%d/%m/%Y")
-                            closed_lot_dict['open_datetime'] = trade_dict['datetime']
-                            closed_lot_dict['open_date'] = closed_lot_dict['open_datetime'].strftime("%d/%m/%Y")
-                            closed_lot_dict['quantity'] = trade_dict['quantity']
-
-                            # the transaction-price for ClosedLot is the open price adjusted for fees:
-                            closed_lot_dict['open_price'] = trade_dict['price']
-
-                            # the transaction-price for the previous Trade is the close price NOT adjusted for fees:
-                            closed_lot_dict['close_price'] = previous_trade_dict['price']
-
-                            # the following works for both long/short positions
-                            closed_lot_dict['close_value'] = closed_lot_dict['quantity'] * closed_lot_dict['close_price']
-
-                            # the open_value already takes into account the fee for opening the position
-                            closed_lot_dict['open_value'] = closed_lot_dict['quantity'] * closed_lot_dict['open_price']
-
-                            # prices written per single stock but option contract are for 100 stock units
-                            if row[col_names['asset_category']] == 'Equity and Index Options':
-                                closed_lot_dict['close_value'] *= 100
-                                closed_lot_dict['open_value'] *= 100
-
-                            # reducing the fee from close_value, but after the multiplication in case of options
-                            # (othersise the fee is artificially multiplied by 100):
-                            closed_lot_dict['close_value'] -= previous_trade_dict['fee']
-
-                            # calculate profit in the original currency
-                            closed_lot_dict['profit'] = closed_lot_dict['close_value'] - closed_lot_dict['open_value']
-
-                            # note position type
-                            if trade_dict['quantity'] > 0:
-                                closed_lot_dict['position_type'] = 'long'
-                            else:
-                                closed_lot_dict['position_type'] = 'short'
-
-                            # convert numbers from base currency to ILS and calculate profit and loss according to Israeli regulation
-                            closed_lot_dict['open_currency_factor'] = coin.convert(1, closed_lot_dict['currency'], 'ILS',
-                                                                                date=closed_lot_dict['open_datetime'])
-                            closed_lot_dict['close_currency_factor'] = coin.convert(1, closed_lot_dict['currency'], 'ILS',
-                                                                                 date=closed_lot_dict['close_datetime'])
-                            closed_lot_dict['currency_factor_ratio'] = closed_lot_dict['close_currency_factor'] / \
-                                                                       closed_lot_dict['open_currency_factor']
-
-                            closed_lot_dict['open_cpi'] = get_israel_cpi_value(closed_lot_dict['open_datetime'])
-                            closed_lot_dict['close_cpi'] = get_israel_cpi_value(closed_lot_dict['close_datetime'])
-                            closed_lot_dict['cpi_ratio'] = closed_lot_dict['close_cpi'] / closed_lot_dict['open_cpi']
-
-                            closed_lot_dict['open_value_ILS'] = closed_lot_dict['open_value'] \
-                                                                * closed_lot_dict['open_currency_factor']
-                            closed_lot_dict['open_value_ILS_adjusted_forex'] = closed_lot_dict['open_value_ILS'] \
-                                                                               * closed_lot_dict['currency_factor_ratio']
-                            closed_lot_dict['open_value_ILS_adjusted_cpi'] = closed_lot_dict['open_value_ILS'] \
-                                                                             * closed_lot_dict['cpi_ratio']
-                            closed_lot_dict['close_value_ILS'] = closed_lot_dict['close_value'] \
-                                                                 * closed_lot_dict['close_currency_factor']
-                            profit_trivial = closed_lot_dict['close_value_ILS'] \
-                                              - closed_lot_dict['open_value_ILS']
-                            profit_adjusted_forex = closed_lot_dict['close_value_ILS'] \
-                                                    - closed_lot_dict['open_value_ILS_adjusted_forex']
-                            profit_adjusted_cpi = closed_lot_dict['close_value_ILS'] \
-                                                  - closed_lot_dict['open_value_ILS_adjusted_cpi']
-                            if closed_lot_dict['profit'] >= 0:
-                                closed_lot_dict['profit_ILS_forex'] = max(min(profit_trivial, profit_adjusted_forex), 0)
-                                closed_lot_dict['profit_ILS_cpi'] = max(min(profit_trivial, profit_adjusted_cpi), 0)
-                            elif closed_lot_dict['profit'] < 0:
-                                closed_lot_dict['profit_ILS_forex'] = min(max(profit_trivial, profit_adjusted_forex), 0)
-                                closed_lot_dict['profit_ILS_cpi'] = min(max(profit_trivial, profit_adjusted_cpi), 0)
-
-                            closed_lots_list += [closed_lot_dict]
-                            closed_lots_datetime_list += [closed_lot_dict['close_datetime']]
-
-        if verbosity == 1:
-            for closed_lot_dict in closed_lots_list:
-                output_string = ''
-                output_string += 'ticker ' + closed_lot_dict['ticker'] + ': '
-                output_string += 'currency ' + closed_lot_dict['currency'] + ', '
-                output_string += 'open_date ' + closed_lot_dict['open_date'] + ', '
-                output_string += 'close_date ' + closed_lot_dict['close_date'] + ', '
-                output_string += 'position_type: ' + closed_lot_dict['position_type'] + ', '
-                output_string += 'quantity=' + str(closed_lot_dict['quantity']) + ', '
-                output_string += 'open_value=' + str(closed_lot_dict['open_value']) + ', '
-                output_string += 'close_value=' + str(closed_lot_dict['close_value']) + ', '
-                output_string += 'profit=' + str(closed_lot_dict['profit']) + ', '
-                rate_open = coin.convert(1, closed_lot_dict['currency'], 'ILS', date=closed_lot_dict['open_datetime'])
-                rate_close = coin.convert(1, closed_lot_dict['currency'], 'ILS', date=closed_lot_dict['close_datetime'])
-                output_string += 'forex rate open=' + str(rate_open) + ', close=' + str(rate_close) + ', '
-                output_string += 'cpi open=' + str(closed_lot_dict['open_cpi']) \
-                                 + ', close=' + str(closed_lot_dict['close_cpi']) \
-                                 + ', ratio=' + str(closed_lot_dict['cpi_ratio'])
-                print(output_string)
-
-        # sort closed-lots by closing date, as required in form 1325
-        inds_sorted_close_dates = [i[0] for i in sorted(enumerate(closed_lots_datetime_list), key=lambda x: x[1])]
+    previous_trade = None
+
+    def handle_trades_row(row, col_names):
+        nonlocal previous_trade
+        # skip irrelevant rows
+        if row[col_names['asset_category']] in TRADES_ASSET_CATEGORIES:
+            trade_type = row[col_names['trade_type']]
+            if 'Trade' in trade_type or 'ClosedLot' in trade_type:
+                # the date is parsed once the date format of the whole file is known, see parse_closed_lots_dates
+                datetime_string = row[col_names['datetime']]
+                quantity = float(row[col_names['quantity']].replace(',', ''))  # remove comma from strings of quantities
+                price = float(row[col_names['price']])
+                if 'Trade' in trade_type:
+                    fee = None
+                    if trade_type == 'Trade':
+                        fee = abs(float(row[col_names['fee']]))
+                    previous_trade = Trade(row[col_names['currency']], row[col_names['ticker']], datetime_string,
+                                           quantity, price, fee)
+                elif 'ClosedLot' in trade_type:
+                    closed_lots_list.append(ClosedLot(currency=row[col_names['currency']],
+                                                      ticker=row[col_names['ticker']],
+                                                      asset_category=row[col_names['asset_category']],
+                                                      open_datetime=datetime_string,
+                                                      close_datetime=previous_trade.datetime,
+                                                      quantity=quantity,
+                                                      open_price=price,
+                                                      close_price=previous_trade.price,
+                                                      close_fee=previous_trade.fee))
+        return
+
+    return handle_trades_row
+
+
+def get_closed_lots_date_strings(closed_lots_list):
+    date_strings = []
+    for closed_lot in closed_lots_list:
+        date_strings += [closed_lot.open_datetime, closed_lot.close_datetime]
+    return date_strings
+
+
+def parse_closed_lots_dates(closed_lots_list, parse_date):
+    for closed_lot in closed_lots_list:
+        closed_lot.open_datetime = parse_date(closed_lot.open_datetime)
+        closed_lot.close_datetime = parse_date(closed_lot.close_datetime)
+    return
+
+
+def compute_closed_lot(closed_lot, fx_table, cpi_store):
+    """
+    calculate the values of a single closed lot, in the original currency and in ILS.
+    """
+    # the following works for both long/short positions
+    closed_lot.close_value = closed_lot.quantity * closed_lot.close_price
+
+    # the open_value already takes into account the fee for opening the position
+    closed_lot.open_value = closed_lot.quantity * closed_lot.open_price
+
+    # prices written per single stock but option contract are for 100 stock units
+    if closed_lot.asset_category == 'Equity and Index Options':
+        closed_lot.close_value *= 100
+        closed_lot.open_value *= 100
+
+    # reducing the fee from close_value, but after the multiplication in case of options
+    # (othersise the fee is artificially multiplied by 100):
+    closed_lot.close_value -= closed_lot.close_fee
+
+    # calculate profit in the original currency
+    closed_lot.profit = closed_lot.close_value - closed_lot.open_value
+
+    # convert numbers from base currency to ILS and calculate profit and loss according to Israeli regulation
+    closed_lot.open_currency_factor = fx_table.get_factor(closed_lot.currency, closed_lot.open_datetime)
+    closed_lot.close_currency_factor = fx_table.get_factor(closed_lot.currency, closed_lot.close_datetime)
+    closed_lot.currency_factor_ratio = closed_lot.close_currency_factor / closed_lot.open_currency_factor
+
+    closed_lot.open_cpi = cpi_store.get_value(closed_lot.open_datetime)
+    closed_lot.close_cpi = cpi_store.get_value(closed_lot.close_datetime)
+    closed_lot.cpi_ratio = closed_lot.close_cpi / closed_lot.open_cpi
+
+    closed_lot.open_value_ILS = closed_lot.open_value * closed_lot.open_currency_factor
+    closed_lot.open_value_ILS_adjusted_forex = closed_lot.open_value_ILS * closed_lot.currency_factor_ratio
+    closed_lot.open_value_ILS_adjusted_cpi = closed_lot.open_value_ILS * closed_lot.cpi_ratio
+    closed_lot.close_value_ILS = closed_lot.close_value * closed_lot.close_currency_factor
+    profit_trivial = closed_lot.close_value_ILS - closed_lot.open_value_ILS
+    profit_adjusted_forex = closed_lot.close_value_ILS - closed_lot.open_value_ILS_adjusted_forex
+    profit_adjusted_cpi = closed_lot.close_value_ILS - closed_lot.open_value_ILS_adjusted_cpi
+    if closed_lot.profit >= 0:
+        closed_lot.profit_ILS_forex = max(min(profit_trivial, profit_adjusted_forex), 0)
+        closed_lot.profit_ILS_cpi = max(min(profit_trivial, profit_adjusted_cpi), 0)
+    elif closed_lot.profit < 0:
+        closed_lot.profit_ILS_forex = min(max(profit_trivial, profit_adjusted_forex), 0)
+        closed_lot.profit_ILS_cpi = min(max(profit_trivial, profit_adjusted_cpi), 0)
+    return
+
+
+def prefetch_closed_lots_rates(closed_lots_list, fx_table, cpi_store, stats):
+    """
+    resolve the FX factors and fetch the CPI values of all the dates of the closed lots, before they are converted.
+    """
+    # every distinct (currency, date) of the run is converted once
+    with stats.stage('fx'):
+        for closed_lot in closed_lots_list:
+            fx_table.add(closed_lot.currency, closed_lot.open_datetime)
+            fx_table.add(closed_lot.currency, closed_lot.close_datetime)
+        fx_table.resolve()
+
+    # all the CPI months of the run are fetched at once, before the lots are converted
+    with stats.stage('cpi'):
+        cpi_store.prefetch([closed_lot.open_datetime for closed_lot in closed_lots_list]
+                           + [closed_lot.close_datetime for closed_lot in closed_lots_list], stats=stats)
+    return
+
+
+def compute_closed_lots_values(closed_lots_list, fx_table, cpi_store, engine, stats):
+    with stats.stage('compute'):
+        if engine == 'scalar':
+            for closed_lot in closed_lots_list:
+                compute_closed_lot(closed_lot, fx_table, cpi_store)
+        elif engine == 'numpy':
+            from closed_lots_vectorized import compute_closed_lots_vectorized
+            compute_closed_lots_vectorized(closed_lots_list, fx_table, cpi_store)
+        else:
+            raise ValueError('invalid engine', engine)
+    return
+
+
+def compute_closed_lots(closed_lots_list, fx_table, cpi_store, verbosity=0, engine='scalar', stats=None):
+    """
+    convert the closed lots to ILS and calculate the profit and loss according to Israeli regulation.
+    engine='scalar' computes lot by lot, engine='numpy' computes all the lots together as column arrays
+    (see closed_lots_vectorized), with exactly the same results.
+    the times of the fx, cpi, compute and sort stages are added to stats if given.
+    returns the indices of the closed lots sorted by closing date.
+    """
+    if stats is None:
+        stats = RunStats()
+    prefetch_closed_lots_rates(closed_lots_list, fx_table, cpi_store, stats)
+    compute_closed_lots_values(closed_lots_list, fx_table, cpi_store, engine, stats)
+
+    if verbosity == 1:
+        for closed_lot in closed_lots_list:
+            output_string = ''
+            output_string += 'ticker ' + closed_lot.ticker + ': '
+            output_string += 'currency ' + closed_lot.currency + ', '
+            output_string += 'open_date ' + closed_lot.open_date + ', '
+            output_string += 'close_date ' + closed_lot.close_date + ', '
+            output_string += 'position_type: ' + closed_lot.position_type + ', '
+            output_string += 'quantity=' + str(closed_lot.quantity) + ', '
+            output_string += 'open_value=' + str(closed_lot.open_value) + ', '
+            output_string += 'close_value=' + str(closed_lot.close_value) + ', '
+            output_string += 'profit=' + str(closed_lot.profit) + ', '
+            output_string += 'forex rate open=' + str(closed_lot.open_currency_factor) \
+                             + ', close=' + str(closed_lot.close_currency_factor) + ', '
+            output_string += 'cpi open=' + str(closed_lot.open_cpi) \
+                             + ', close=' + str(closed_lot.close_cpi) \
+                             + ', ratio=' + str(closed_lot.cpi_ratio)
+            print(output_string)
+
+    with stats.stage('sort'):
+        inds_sorted_close_dates = get_inds_sorted_close_dates(closed_lots_list)
+    return inds_sorted_close_dates
+
+
+def get_last_date(closed_lots_list, dividends_list):
+    """
+    the last date the run needs FX rates for (a lot is always opened before it is closed), None if there are no records.
+    """
+    datetimes = [closed_lot.close_datetime for closed_lot in closed_lots_list] \
+                + [dividend.datetime for dividend in dividends_list]
+    if len(datetimes) == 0:
+        return None
+    return max(datetimes)
+
+
+def get_inds_sorted_close_dates(closed_lots_list):
+    # sort closed-lots by closing date, as required in form 1325
+    closed_lots_datetime_list = [closed_lot.close_datetime for closed_lot in closed_lots_list]
+    return [i[0] for i in sorted(enumerate(closed_lots_datetime_list), key=lambda x: x[1])]
 
+
+def extract_trades_data_from_csv(file_dir, csv_file_name, verbosity=0, date_slash_format=None, cpi_store=None,
+                                 engine='scalar'):
+    """
+    read the csv output file from IB and extract the necessary data for closing transactions
+    """
+    csv_file = file_dir + '/' + csv_file_name + '.csv'
+    closed_lots_list = []
+    sections_col_names = read_statement_sections(csv_file,
+                                                 {'Trades': get_trades_section_handler(closed_lots_list)},
+                                                 verbosity=verbosity)
+
+    if 'Trades' in sections_col_names:
+        parse_closed_lots_dates(closed_lots_list, get_file_date_parser(closed_lots_list, [], date_slash_format))
+        if cpi_store is None:
+            cpi_store = get_default_cpi_store()
+        # using the local snapshot of the ECB database
+        fx_table = FxLookupTable(get_ecb_rate_store(last_date=get_last_date(closed_lots_list, [])))
+        inds_sorted_close_dates = compute_closed_lots(closed_lots_list, fx_table, cpi_store, verbosity=verbosity,
+                                                      engine=engine)
         return closed_lots_list, inds_sorted_close_dates
 
     else:
         print('no trades exist in the file.')
         return [], []
 
-def extract_dividends_data_from_csv(file_dir, csv_file_name, verbosity=0, date_slash_format='normal'):
+def get_dividends_section_handler(dividend_events):
+    """
+    returns the handler of the 'Dividends' and 'Withholding Tax' rows of the csv file, that appends them to
+    dividend_events as (section, ticker, datetime string, currency, amount), to be merged by merge_dividend_events.
+    """
+    def handle_dividends_row(row, col_names):
+        currency = row[col_names['currency']]
+        if 'Total' not in currency:
+            dividend_events.append((row[col_names['main']], row[col_names['ticker']].split('(')[0],
+                                    row[col_names['datetime']], currency, float(row[col_names['amount']])))
+        return
+
+    return handle_dividends_row
+
+
+def merge_dividend_events(dividend_events, parse_date, stats=None):
+    """
+    build the dividends list, adding the withholding tax to the matching dividend.
+    rows are matched by (ticker, pay date, currency) through an index, so the order of the rows in the file does not
+    matter: repeated dividend rows (e.g. reversals) are merged, and withholding tax that appears before its dividend
+    is kept aside until the dividend is read. tax corrections and reversals are summed with their sign.
+    withholding tax left without a matching dividend is not in the tax forms, it is printed as a warning and counted
+    in stats (unmatched_withholding_tax) if given.
+    """
+    dividends_list = []
+    dividends_index = {}
+    pending_withholding_tax = {}
+    for section, ticker, datetime_string, currency, amount in dividend_events:
+        event_datetime = parse_date(datetime_string)
+        key = (ticker, event_datetime, currency)
+        if section == 'Dividends':
+            if key in dividends_index:
+                dividends_index[key].amount += amount
+            else:
+                dividend = Dividend(currency, ticker, event_datetime, amount,
+                                    withholding_tax=pending_withholding_tax.pop(key, 0))
+                dividends_index[key] = dividend
+                dividends_list.append(dividend)
+        elif section == 'Withholding Tax':
+            if key in dividends_index:
+                dividends_index[key].withholding_tax += amount
+            else:
+                pending_withholding_tax[key] = pending_withholding_tax.get(key, 0) + amount
+
+    for (ticker, event_datetime, currency), amount in pending_withholding_tax.items():
+        print('warning: withholding tax without a matching dividend: ' + ticker + ' ' + str(event_datetime.date())
+              + ' ' + currency + ' ' + str(amount))
+    if stats is not None:
+        stats.count('unmatched_withholding_tax', len(pending_withholding_tax))
+    return dividends_list
+
+
+def compute_dividends(dividends_list, fx_table, stats=None):
+    """
+    some post-processing for the dividends: conversion of the dividend and withholding tax to ILS
+    """
+    if stats is None:
+        stats = RunStats()
+    with stats.stage('fx'):
+        for dividend in dividends_list:
+            fx_table.add(dividend.currency, dividend.datetime)
+        fx_table.resolve()
+
+    with stats.stage('compute'):
+        for dividend in dividends_list:
+            dividend.currency_factor = fx_table.get_factor(dividend.currency, dividend.datetime)
+            dividend.dividend_ILS = dividend.dividend * dividend.currency_factor
+            dividend.withholding_tax_ILS = dividend.withholding_tax * dividend.currency_factor
+    return
+
+
+def extract_dividends_data_from_csv(file_dir, csv_file_name, verbosity=0, date_slash_format=None):
     """
     read the csv output file from IB and extract the necessary data for dividends
     """
     csv_file = file_dir + '/' + csv_file_name + '.csv'
-    coin = CurrencyConverter(ECB_URL, fallback_on_missing_rate=True)  # using the ECB database
-
-    # csv file column definitions
-    col_names = get_dividends_col_names(csv_file)
-
-    if len(col_names) > 0:
-        # open file in read mode
-        with open(csv_file, 'r') as read_obj:
-            csv_reader = csv.reader(read_obj)
-            dividends_list = []
-            for row in csv_reader:
-                if verbosity == 1:
-                    print(row)
-                if row[col_names['main']] in ['Dividends', 'Withholding Tax'] and row[col_names['header']] == 'Data':
-                    event_dict = {}
-                    event_dict['currency'] = row[col_names['currency']]
-                    if 'Total' not in event_dict['currency']:
-                        datetime_string = row[col_names['datetime']]
-                        date_format = get_date_format(datetime_string, date_slash_format=date_slash_format)
-                        event_dict['datetime'] = datetime.datetime.strptime(datetime_string, date_format)
-                        event_dict['date'] = event_dict['datetime'].strftime("%d/%m/%Y")
-                        event_dict['ticker'] = row[col_names['ticker']].split('(')[0]
-                        event_dict['amount'] = float(row[col_names['amount']])
-                        if row[col_names['main']] == 'Dividends':
-                            if len(dividends_list) > 0 and dividends_list[-1]['ticker'] == event_dict['ticker'] \
-                                    and dividends_list[-1]['date'] == event_dict['date']:
-                                dividends_list[-1]['amount'] += event_dict['amount']
-                            else:
-                                event_dict['withholding_tax'] = 0
-                                dividends_list += [event_dict]
-                        elif row[col_names['main']] == 'Withholding Tax':
-                            # find correct element in dividends list
-                            ind_correct = None
-                            for ind, dividend_dict in enumerate(dividends_list):
-                                if dividend_dict['ticker'] == event_dict['ticker'] \
-                                        and dividend_dict['date'] == event_dict['date']:
-                                    ind_correct = ind
-                                    break
-
-                            if ind_correct is not None:
-                                dividends_list[ind_correct]['withholding_tax'] += event_dict['amount']
-
-        # some post-processing for the dividends
-        for ind, dividend_dict in enumerate(dividends_list):
-            dividend_dict['currency_factor'] = coin.convert(1, dividend_dict['currency'], 'ILS',
-                                                         date=dividend_dict['datetime'])
-            dividend_dict['dividend'] = dividend_dict['amount']
-            dividend_dict['dividend_ILS'] = dividend_dict['dividend'] * dividend_dict['currency_factor']
-            dividend_dict['withholding_tax_ILS'] = dividend_dict['withholding_tax'] * dividend_dict['currency_factor']
-
+    dividend_events = []
+    handle_dividends_row = get_dividends_section_handler(dividend_events)
+    sections_col_names = read_statement_sections(csv_file,
+                                                 {'Dividends': handle_dividends_row,
+                                                  'Withholding Tax': handle_dividends_row},
+                                                 verbosity=verbosity)
+
+    if 'Dividends' in sections_col_names or 'Withholding Tax' in sections_col_names:
+        parse_date = get_file_date_parser([], dividend_events, date_slash_format)
+        dividends_list = merge_dividend_events(dividend_events, parse_date)
+        # using the local snapshot of the ECB database
+        fx_table = FxLookupTable(get_ecb_rate_store(last_date=get_last_date([], dividends_list)))
+        compute_dividends(dividends_list, fx_table)
         return dividends_list
 
     else:
         print('no dividends exist in the file.')
         return []
 
-def write_tax_form_files(file_dir, csv_file_name, closed_lots_list, inds_sorted_close_dates, dividends_list):
+def get_file_date_parser(closed_lots_list, dividend_events, date_slash_format=None):
     """
-    write an Excel file with summary of transactions in the correct format of form 1325,
+    the date parser of the file. unless date_slash_format is given, the order of the dates with slashes is inferred
+    from all the dates of the closed lots and dividends at once.
+    """
+    if date_slash_format is None:
+        date_slash_format = infer_date_slash_format([event[2] for event in dividend_events]
+                                                    + get_closed_lots_date_strings(closed_lots_list))
+    return get_date_parser(date_slash_format)
+
+
+def read_tax_data_from_csv(file_dir, csv_file_name, verbosity=0, date_slash_format=None, stats=None):
+    """
+    read the closed lots and the dividends (before conversion to ILS) in a single pass over the csv file.
+    raises ValueError if the file has none of the Trades, Dividends and Withholding Tax sections (i.e. it is not an IB
+    activity statement).
+    """
+    if stats is None:
+        stats = RunStats()
+    csv_file = file_dir + '/' + csv_file_name + '.csv'
+    closed_lots_list = []
+    dividend_events = []
+    handle_dividends_row = get_dividends_section_handler(dividend_events)
+    with stats.stage('parse'):
+        sections_col_names = read_statement_sections(csv_file,
+                                                     {'Trades': get_trades_section_handler(closed_lots_list),
+                                                      'Dividends': handle_dividends_row,
+                                                      'Withholding Tax': handle_dividends_row},
+                                                     verbosity=verbosity, stats=stats)
+        if len(sections_col_names) == 0:
+            raise ValueError('no Trades, Dividends or Withholding Tax section in the csv file', csv_file)
+        parse_date = get_file_date_parser(closed_lots_list, dividend_events, date_slash_format)
+        parse_closed_lots_dates(closed_lots_list, parse_date)
+        dividends_list = merge_dividend_events(dividend_events, parse_date, stats=stats)
+    stats.count('closed_lots', len(closed_lots_list))
+    stats.count('dividends', len(dividends_list))
+    return closed_lots_list, dividends_list
+
+# output columns of form 1325 that are the same in both capital gains sheets, including the extra columns that are
+# not needed for form 1325, but printed for the user (V to Z)
+CAPITAL_GAINS_SHEET_COLUMNS = [('C', 'ticker'), ('E', 'currency'), ('G', 'open_date'), ('N', 'close_date'),
+                               ('H', 'open_value'), ('F', 'close_value'), ('I', 'open_value_ILS'),
+                               ('J', 'open_currency_factor'), ('K', 'close_currency_factor'), ('O', 'close_value_ILS'),
+                               ('V', 'position_type'), ('W', 'quantity'), ('X', 'open_price'), ('Y', 'close_price'),
+                               ('Z', 'profit')]
+# the columns that differ between the sheets: (sheet name, ratio in column L, adjusted open value in column M, profit)
+CAPITAL_GAINS_SHEETS = [('Capital Gains (FOREX adjusted)', 'currency_factor_ratio', 'open_value_ILS_adjusted_forex',
+                         'profit_ILS_forex'),
+                        ('Capital Gains (CPI adjusted)', 'cpi_ratio', 'open_value_ILS_adjusted_cpi',
+                         'profit_ILS_cpi')]
+DIVIDENDS_SHEET_COLUMNS = [('C', 'date'), ('D', 'ticker'), ('E', 'currency'), ('F', 'dividend'),
+                           ('G', 'withholding_tax'), ('H', 'currency_factor'), ('I', 'dividend_ILS'),
+                           ('J', 'withholding_tax_ILS')]
+
+# the plain table exports are written next to the statement as tax_forms_<statement name>_<table name>.<format>
+EXPORT_TABLE_NAMES = ['capital_gains', 'dividends']
+# columns of the plain table exports
+CAPITAL_GAINS_TABLE_FIELDS = ['ticker', 'currency', 'position_type', 'quantity', 'open_date', 'close_date',
+                              'open_price', 'close_price', 'open_value', 'close_value', 'profit',
+                              'open_currency_factor', 'close_currency_factor', 'currency_factor_ratio',
+                              'open_cpi', 'close_cpi', 'cpi_ratio', 'open_value_ILS', 'open_value_ILS_adjusted_forex',
+                              'open_value_ILS_adjusted_cpi', 'close_value_ILS', 'profit_ILS_forex', 'profit_ILS_cpi']
+DIVIDENDS_TABLE_FIELDS = ['date', 'ticker', 'currency', 'dividend', 'withholding_tax', 'currency_factor',
+                          'dividend_ILS', 'withholding_tax_ILS']
+
+
+def get_capital_gains_totals(sorted_closed_lots):
+    """
+    the totals of the capital gains sheets, summed in the order of form 1325.
+    returns the number of closed lots, the total sell amount in ILS (T5) and the total profit and loss in ILS of every
+    sheet of CAPITAL_GAINS_SHEETS (S5).
+    """
+    num_closed_lots = 0
+    total_sell_amount_ILS = 0
+    totals_profit_and_loss_ILS = [0] * len(CAPITAL_GAINS_SHEETS)
+    for closed_lot in sorted_closed_lots:
+        if closed_lot.position_type == 'long':
+            total_sell_amount_ILS += closed_lot.close_value_ILS
+        elif closed_lot.position_type == 'short':
+            total_sell_amount_ILS += abs(closed_lot.open_value_ILS)
+        for ind_sheet, (_, _, _, profit_ILS_name) in enumerate(CAPITAL_GAINS_SHEETS):
+            totals_profit_and_loss_ILS[ind_sheet] += getattr(closed_lot, profit_ILS_name)
+        num_closed_lots += 1
+    return num_closed_lots, total_sell_amount_ILS, totals_profit_and_loss_ILS
+
+
+def get_dividends_totals(dividends_list):
+    """
+    the totals of the dividends sheet in ILS: dividends (I5), withholding tax (J5) and dividends minus tax (L5).
+    """
+    total_dividends_ILS = 0
+    withholding_tax_ILS = 0
+    total_dividends_minus_tax_ILS = 0
+    for dividend in dividends_list:
+        total_dividends_ILS += dividend.dividend_ILS
+        withholding_tax_ILS += dividend.withholding_tax_ILS
+        total_dividends_minus_tax_ILS += dividend.dividend_ILS - abs(dividend.withholding_tax_ILS)
+    return total_dividends_ILS, withholding_tax_ILS, total_dividends_minus_tax_ILS
+
+
+# the style tables of a workbook, the cells refer to their styles by the indexes in these tables. these (and the
+# loaded_theme of the workbook and the _style of the cells) are internals of openpyxl, only used by
+# get_write_only_template_copy and TemplateSheetWriter, and checked by check_tax_form_workbook.py
+TEMPLATE_STYLES_NAMES = ['_fonts', '_fills', '_borders', '_alignments', '_protections', '_number_formats',
+                         '_date_formats', '_timedelta_formats', '_cell_styles', '_named_styles', '_table_styles',
+                         '_differential_styles']
+
+
+def get_write_only_template_copy(template):
+    """
+    a new write-only workbook that takes the theme and the style tables of the template workbook, so the styles of the
+    template cells (and its default style, of the cells without one) are valid in it as they are.
+    raises ImportError if the installed openpyxl does not have the internals this relies on, and ValueError if the
+    template has workbook features that are not copied.
+    """
+    import openpyxl
+
+    xfile = openpyxl.Workbook(write_only=True)
+    missing_names = [name for name in TEMPLATE_STYLES_NAMES + ['loaded_theme']
+                     if not (hasattr(template, name) and hasattr(xfile, name))]
+    if not hasattr(openpyxl.cell.Cell, '_style'):
+        missing_names += ['Cell._style']
+    if len(missing_names) > 0:
+        raise ImportError('the workbook writer relies on internals that openpyxl ' + openpyxl.__version__
+                          + ' does not have: ' + ', '.join(missing_names))
+    if len(template.defined_names) > 0:
+        raise ValueError('the defined names of the template are not copied to the workbook',
+                         list(template.defined_names))
+    xfile.loaded_theme = template.loaded_theme
+    for styles_name in TEMPLATE_STYLES_NAMES:
+        setattr(xfile, styles_name, getattr(template, styles_name))
+    return xfile
+
+
+class TemplateSheetWriter:
+    """
+    Writes a sheet of a write-only workbook as a copy of a sheet of the template workbook: the sheet settings, column
+    widths and row heights are copied, and the rows are appended from the top, every cell taking the style (and the
+    value, unless given) of the same cell of the template, whose style tables the write-only workbook must share. cells
+    below the template take the default style of the template. rows can only be appended in order, so the totals in
+    row 5 must be known before the rows of the records are written.
+    """
+
+    def __init__(self, xfile, template_sheet):
+        # the features of the template sheet that are not copied, a template that has them fails here
+        unsupported_features = [('merged cells', len(template_sheet.merged_cells.ranges)),
+                                ('conditional formatting', len(template_sheet.conditional_formatting)),
+                                ('data validations', len(template_sheet.data_validations.dataValidation)),
+                                ('defined names', len(template_sheet.defined_names)),
+                                ('tables', len(template_sheet.tables)),
+                                ('images', len(template_sheet._images)),
+                                ('charts', len(template_sheet._charts)),
+                                ('auto filter', template_sheet.auto_filter.ref is not None),
+                                ('sheet protection', template_sheet.protection.sheet)]
+        unsupported_features = [feature for feature, is_used in unsupported_features if is_used]
+        if len(unsupported_features) > 0:
+            raise ValueError('the template sheet has features that are not copied to the workbook',
+                             template_sheet.title, unsupported_features)
+        self.template_sheet = template_sheet
+        self.template_rows = list(template_sheet.iter_rows())
+        self.sheet = xfile.create_sheet(template_sheet.title)
+        self.sheet.sheet_format = copy.copy(template_sheet.sheet_format)
+        self.sheet.sheet_properties = copy.copy(template_sheet.sheet_properties)
+        self.sheet.views = copy.copy(template_sheet.views)
+        self.sheet.page_setup = copy.copy(template_sheet.page_setup)
+        self.sheet.page_margins = copy.copy(template_sheet.page_margins)
+        self.sheet.print_options = copy.copy(template_sheet.print_options)
+        for col, column_dimension in template_sheet.column_dimensions.items():
+            self.sheet.column_dimensions[col].width = column_dimension.width
+            self.sheet.column_dimensions[col].hidden = column_dimension.hidden
+        for num_row, row_dimension in template_sheet.row_dimensions.items():
+            if row_dimension.height is not None:
+                self.sheet.row_dimensions[num_row].height = row_dimension.height
+        self.num_rows = 0
+
+    def append(self, values=None):
+        """
+        append the next row, values is {column index (1-based): value}.
+        """
+        from openpyxl.cell import WriteOnlyCell
+
+        if values is None:
+            values = {}
+        num_cols = max(values) if len(values) > 0 else 0
+        if self.num_rows < len(self.template_rows):
+            template_row = self.template_rows[self.num_rows]
+            row = []
+            for template_cell in template_row:
+                value = values.get(template_cell.column, template_cell.value)
+                if template_cell.has_style:
+                    cell = WriteOnlyCell(self.sheet, value)
+                    cell._style = copy.copy(template_cell._style)
+                    row.append(cell)
+                else:
+                    row.append(value)
+            row += [values.get(col_index) for col_index in range(len(template_row) + 1, num_cols + 1)]
+        else:
+            row = [values.get(col_index) for col_index in range(1, num_cols + 1)]
+        self.sheet.append(row)
+        self.num_rows += 1
+        return
+
+
+def get_tax_form_workbook(sorted_closed_lots, dividends_list):
+    """
+    fill a copy of the template workbook with summary of transactions in the correct format of form 1325,
     and dividends + withohlding tax table and summary for forms 1322 + 1324.
+    the workbook is write-only: it is written row by row from a copy of the template (see TemplateSheetWriter), and
+    its rows are kept in temporary files until it is saved, so the memory does not grow with the cells.
+    sorted_closed_lots is iterated twice, for the totals in row 5 and then for the rows (e.g. a list, or a
+    statement_stream.SortedClosedLots).
     """
+    import openpyxl
+    from openpyxl.utils import column_index_from_string
 
     template_file = os.path.dirname(os.path.abspath(__file__)) + '/tax_forms_template.xlsx'
-    xfile = openpyxl.load_workbook(template_file)
-
-    if len(closed_lots_list) > 0:
-        for sheet_name in ['Capital Gains (FOREX adjusted)', 'Capital Gains (CPI adjusted)']:
-            sheet = xfile.get_sheet_by_name(sheet_name)
-            total_profit_and_loss_ILS = 0
-            total_sell_amount_ILS = 0
-            for ind_line, ind_sort in enumerate(inds_sorted_close_dates):
-                closed_lot_dict = closed_lots_list[ind_sort]
-                num_row = ind_line + 6
-                sheet['B' + str(num_row)] = ind_line + 1
-                sheet['C' + str(num_row)] = closed_lot_dict['ticker']
-                sheet['E' + str(num_row)] = closed_lot_dict['currency']
-                sheet['G' + str(num_row)] = closed_lot_dict['open_date']
-                sheet['N' + str(num_row)] = closed_lot_dict['close_date']
-                sheet['H' + str(num_row)] = closed_lot_dict['open_value']
-                sheet['F' + str(num_row)] = closed_lot_dict['close_value']
-                sheet['I' + str(num_row)] = closed_lot_dict['open_value_ILS']
-                sheet['J' + str(num_row)] = closed_lot_dict['open_currency_factor']
-                sheet['K' + str(num_row)] = closed_lot_dict['close_currency_factor']
-                sheet['O' + str(num_row)] = closed_lot_dict['close_value_ILS']
-                if sheet_name == 'Capital Gains (FOREX adjusted)':
-                    sheet['L' + str(num_row)] = closed_lot_dict['currency_factor_ratio']
-                    sheet['M' + str(num_row)] = closed_lot_dict['open_value_ILS_adjusted_forex']
-                    profit_ILS_name = 'profit_ILS_forex'
-                elif sheet_name == 'Capital Gains (CPI adjusted)':
-                    sheet['L' + str(num_row)] = closed_lot_dict['cpi_ratio']
-                    sheet['M' + str(num_row)] = closed_lot_dict['open_value_ILS_adjusted_cpi']
-                    profit_ILS_name = 'profit_ILS_cpi'
-                else:
-                    raise ValueError('invalid option for sheet_name', sheet_name)
+    template = openpyxl.load_workbook(template_file)
+    xfile = get_write_only_template_copy(template)
+    sheet_writers = {template_sheet.title: TemplateSheetWriter(xfile, template_sheet)
+                     for template_sheet in template.worksheets}
+
+    # the totals of the capital gains sheets are written in row 5, before the rows of the lots
+    num_closed_lots, total_sell_amount_ILS, totals_profit_and_loss_ILS = get_capital_gains_totals(sorted_closed_lots)
+    capital_gains_writers = [sheet_writers[sheet_name] for sheet_name, _, _, _ in CAPITAL_GAINS_SHEETS]
+    for ind_sheet, sheet_writer in enumerate(capital_gains_writers):
+        for num_row in range(1, 6):
+            values = {}
+            if num_row == 5 and num_closed_lots > 0:
+                values = {column_index_from_string('S'): totals_profit_and_loss_ILS[ind_sheet],
+                          column_index_from_string('T'): total_sell_amount_ILS}
+            sheet_writer.append(values)
+
+    get_shared_values = operator.attrgetter(*[field for _, field in CAPITAL_GAINS_SHEET_COLUMNS])
+    shared_col_indices = [2] + [column_index_from_string(col) for col, _ in CAPITAL_GAINS_SHEET_COLUMNS]
+    for ind_line, closed_lot in enumerate(sorted_closed_lots):
+        shared_values = dict(zip(shared_col_indices, (ind_line + 1,) + get_shared_values(closed_lot)))
+        for sheet_writer, (_, ratio_name, open_value_adjusted_name, profit_ILS_name) \
+                in zip(capital_gains_writers, CAPITAL_GAINS_SHEETS):
+            # the ratio (L) and adjusted open value (M), and the profit (P) or loss (Q) of the sheet
+            values = dict(shared_values)
+            values[12] = getattr(closed_lot, ratio_name)
+            values[13] = getattr(closed_lot, open_value_adjusted_name)
+            profit_ILS = getattr(closed_lot, profit_ILS_name)
+            values[16 if profit_ILS >= 0 else 17] = profit_ILS
+            sheet_writer.append(values)
+
+    sheet_writer = sheet_writers['Dividends']
+    for num_row in range(1, 6):
+        values = {}
+        if num_row == 5 and len(dividends_list) > 0:
+            values = dict(zip([column_index_from_string(col) for col in ['I', 'J', 'L']],
+                              get_dividends_totals(dividends_list)))
+        sheet_writer.append(values)
+    get_dividend_values = operator.attrgetter(*[field for _, field in DIVIDENDS_SHEET_COLUMNS])
+    dividend_col_indices = [2] + [column_index_from_string(col) for col, _ in DIVIDENDS_SHEET_COLUMNS]
+    for ind_line, dividend in enumerate(dividends_list):
+        sheet_writer.append(dict(zip(dividend_col_indices, (ind_line + 1,) + get_dividend_values(dividend))))
+
+    # the rows of the template below the records keep its formatting
+    for sheet_writer in sheet_writers.values():
+        while sheet_writer.num_rows < len(sheet_writer.template_rows):
+            sheet_writer.append()
+    return xfile
+
+
+def write_tax_form_files(file_dir, csv_file_name, closed_lots_list, inds_sorted_close_dates, dividends_list,
+                         stats=None):
+    """
+    write the Excel file of the tax forms (see get_tax_form_workbook)
+    """
+    if stats is None:
+        stats = RunStats()
+    with stats.stage('excel_write'):
+        xfile = get_tax_form_workbook([closed_lots_list[ind_sort] for ind_sort in inds_sorted_close_dates],
+                                      dividends_list)
+    with stats.stage('save'):
+        xfile.save(file_dir + '/tax_forms_' + csv_file_name + '.xlsx')
+    return
 
-                if closed_lot_dict[profit_ILS_name] >= 0:
-                    sheet['P' + str(num_row)] = closed_lot_dict[profit_ILS_name]
-                else:
-                    sheet['Q' + str(num_row)] = closed_lot_dict[profit_ILS_name]
-                total_profit_and_loss_ILS += closed_lot_dict[profit_ILS_name]
-
-                # summing all sell prices (or absolute value of buy prices in case of short position)
-                if closed_lot_dict['position_type'] == 'long':
-                    total_sell_amount_ILS += closed_lot_dict['close_value_ILS']
-                elif closed_lot_dict['position_type'] == 'short':
-                    total_sell_amount_ILS += abs(closed_lot_dict['open_value_ILS'])
-
-                # extra columns not needed for form 1325, but printed for the user:
-                sheet['V' + str(num_row)] = closed_lot_dict['position_type']
-                sheet['W' + str(num_row)] = closed_lot_dict['quantity']
-                sheet['X' + str(num_row)] = closed_lot_dict['open_price']
-                sheet['Y' + str(num_row)] = closed_lot_dict['close_price']
-                sheet['Z' + str(num_row)] = closed_lot_dict['profit']
-
-            sheet['S5'] = total_profit_and_loss_ILS
-            sheet['T5'] = total_sell_amount_ILS
-
-    if len(dividends_list) > 0:
-        sheet = xfile.get_sheet_by_name('Dividends')
-        total_dividends = 0
-        total_dividends_ILS = 0
-        withholding_tax = 0
-        withholding_tax_ILS = 0
-        total_dividends_minus_tax = 0
-        total_dividends_minus_tax_ILS = 0
-        for ind_line, dividend_dict in enumerate(dividends_list):
-            num_row = ind_line + 6
-            sheet['B' + str(num_row)] = ind_line + 1
-            sheet['C' + str(num_row)] = dividend_dict['date']
-            sheet['D' + str(num_row)] = dividend_dict['ticker']
-            sheet['E' + str(num_row)] = dividend_dict['currency']
-            sheet['F' + str(num_row)] = dividend_dict['dividend']
-            sheet['G' + str(num_row)] = dividend_dict['withholding_tax']
-            sheet['H' + str(num_row)] = dividend_dict['currency_factor']
-            sheet['I' + str(num_row)] = dividend_dict['dividend_ILS']
-            sheet['J' + str(num_row)] = dividend_dict['withholding_tax_ILS']
-
-            total_dividends += dividend_dict['dividend']
-            total_dividends_ILS += dividend_dict['dividend_ILS']
-            withholding_tax += dividend_dict['withholding_tax']
-            withholding_tax_ILS += dividend_dict['withholding_tax_ILS']
-
-            total_dividends_minus_tax += dividend_dict['dividend'] - abs(dividend_dict['withholding_tax'])
-            total_dividends_minus_tax_ILS += dividend_dict['dividend_ILS'] - abs(dividend_dict['withholding_tax_ILS'])
-
-        sheet['I5'] = total_dividends_ILS
-        sheet['J5'] = withholding_tax_ILS
-        sheet['L5'] = total_dividends_minus_tax_ILS
-
-    xfile.save(file_dir + '/tax_forms_' + csv_file_name + '.xlsx')
+
+def write_table_file(table_file, fields, rows, export_format):
+    if export_format == 'csv':
+        with open(table_file, 'w', newline='') as write_obj:
+            csv_writer = csv.writer(write_obj)
+            csv_writer.writerow(fields)
+            csv_writer.writerows(rows)
+    elif export_format == 'parquet':
+        # the columns are built in memory, a stream of rows is only written through with the csv format
+        rows = list(rows)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('pyarrow is required for parquet export (pip install pyarrow)')
+        columns = {field: list(values) for field, values in zip(fields, zip(*rows))} if len(rows) > 0 \
+            else {field: [] for field in fields}
+        pyarrow.parquet.write_table(pyarrow.table(columns), table_file)
+    else:
+        raise ValueError('invalid export_format', export_format)
     return
 
 
-def generate_tax_forms(file_dir, csv_file_name, verbosity=0):
+def export_tax_tables(file_dir, csv_file_name, sorted_closed_lots, dividends_list, export_format='csv'):
+    """
+    write the closed lots (sorted by closing date, as in form 1325) and the dividends as plain tables
+    for downstream systems, export_format is 'csv' or 'parquet'.
+    sorted_closed_lots can be any iterable, with the csv format it is written row by row.
+    """
+    get_closed_lot_values = operator.attrgetter(*CAPITAL_GAINS_TABLE_FIELDS)
+    write_table_file(file_dir + '/tax_forms_' + csv_file_name + '_capital_gains.' + export_format,
+                     CAPITAL_GAINS_TABLE_FIELDS,
+                     (get_closed_lot_values(closed_lot) for closed_lot in sorted_closed_lots),
+                     export_format)
+    get_dividend_values = operator.attrgetter(*DIVIDENDS_TABLE_FIELDS)
+    write_table_file(file_dir + '/tax_forms_' + csv_file_name + '_dividends.' + export_format,
+                     DIVIDENDS_TABLE_FIELDS,
+                     [get_dividend_values(dividend) for dividend in dividends_list],
+                     export_format)
+    return
+
+
+def generate_tax_forms(file_dir, csv_file_name, verbosity=0, refresh_rates=False, engine='scalar', export_formats=(),
+                       profile=False, profile_file=None, use_result_cache=True, input_format='csv'):
     """
     Input a csv report from IB as defined in the Facebook post:
     https://www.facebook.com/groups/Fininja/posts/1439526366410898/
+    or, with input_format='xml', an IB Flex Query xml file with the trades (including closed lots) and the cash
+    transactions (see flex_statement), csv_file_name is then the name of the xml file (without suffix).
     Output is an Excel file with data necessary for tax forms 1325, 1322, 1324.
+    The ECB rates are read from a local snapshot, which is downloaded again if refresh_rates=True or if the statement
+    has dates past its end.
+    engine='numpy' computes the closed lots in batch, which is faster for statements with very many lots.
+    export_formats can include 'csv' and 'parquet', to also write the tables as plain files.
+    With use_result_cache=True the computed closed lots and dividends are kept between runs (see
+    result_cache.StatementResultCache): an unchanged file is not computed again, and for a corrected or extended
+    file only the new or changed rows are computed.
+    Returns the stats of the run (see run_stats.RunStats): the wall time of every stage and counters of rows, lots,
+    HTTP requests and cache hits/misses, which are printed if profile=True and written to profile_file as json.
     """
-    try:
-        closed_lots_list, inds_sorted_close_dates = extract_trades_data_from_csv(file_dir, csv_file_name,
-                                                                                 verbosity=verbosity)
-        dividends_list = extract_dividends_data_from_csv(file_dir, csv_file_name, verbosity=verbosity)
-    except:
-        print("failed to use date_slash_format='normal' somewhere in the csv file, attemping date_slash_format='USA'")
-        closed_lots_list, inds_sorted_close_dates = extract_trades_data_from_csv(file_dir, csv_file_name,
-                                                                                 verbosity=verbosity,
-                                                                                 date_slash_format='USA')
-        dividends_list = extract_dividends_data_from_csv(file_dir, csv_file_name, verbosity=verbosity,
-                                                         date_slash_format='USA')
-    write_tax_form_files(file_dir, csv_file_name, closed_lots_list, inds_sorted_close_dates, dividends_list)
+    stats = RunStats()
+    # the requests are counted where they are made, the counters are listed even if there were none
+    for counter_name in ['http_requests', 'ecb_downloads', 'cpi_hits', 'cpi_misses']:
+        stats.count(counter_name, 0)
+    with stats.stage('fx'):
+        ecb_rate_store = get_ecb_rate_store(refresh=refresh_rates, stats=stats)
+    with stats.stage('cpi'):
+        cpi_store = get_default_cpi_store()
+
+    if input_format not in ['csv', 'xml']:
+        raise ValueError('invalid input_format', input_format)
+    input_file = file_dir + '/' + csv_file_name + '.' + input_format
+    result_cache = None
+    if use_result_cache:
+        with stats.stage('result_cache'):
+            result_cache = StatementResultCache(input_file)
+    if result_cache is not None and result_cache.is_complete():
+        with stats.stage('result_cache'):
+            closed_lots_list, dividends_list = result_cache.load_records()
+        stats.count('closed_lots', len(closed_lots_list))
+        stats.count('dividends', len(dividends_list))
+        new_closed_lots = []
+        new_dividends = []
+    else:
+        if input_format == 'xml':
+            from flex_statement import read_tax_data_from_flex_xml
+            closed_lots_list, dividends_list = read_tax_data_from_flex_xml(input_file, stats=stats)
+        else:
+            closed_lots_list, dividends_list = read_tax_data_from_csv(file_dir, csv_file_name, verbosity=verbosity,
+                                                                      stats=stats)
+        new_closed_lots = closed_lots_list
+        new_dividends = dividends_list
+        if result_cache is not None:
+            with stats.stage('result_cache'):
+                new_closed_lots = result_cache.restore_closed_lots(closed_lots_list)
+                new_dividends = result_cache.restore_dividends(dividends_list)
+    stats.count('cached_closed_lots', len(closed_lots_list) - len(new_closed_lots))
+    stats.count('cached_dividends', len(dividends_list) - len(new_dividends))
+    with stats.stage('fx'):
+        ecb_rate_store = get_ecb_rate_store(last_date=get_last_date(new_closed_lots, new_dividends), stats=stats)
+
+    # a single FX table is shared by the trades and the dividends
+    fx_table = FxLookupTable(ecb_rate_store)
+    if len(new_closed_lots) > 0:
+        inds_sorted_close_dates = compute_closed_lots(new_closed_lots, fx_table, cpi_store,
+                                                      verbosity=verbosity, engine=engine, stats=stats)
+    else:
+        inds_sorted_close_dates = []
+    if len(new_closed_lots) < len(closed_lots_list):
+        with stats.stage('sort'):
+            inds_sorted_close_dates = get_inds_sorted_close_dates(closed_lots_list)
+    compute_dividends(new_dividends, fx_table, stats=stats)
+    if result_cache is not None and not result_cache.is_complete():
+        with stats.stage('result_cache'):
+            result_cache.save(closed_lots_list, dividends_list, cpi_store)
+    if verbosity == 1:
+        print('FX lookups:', fx_table.get_stats())
+    write_tax_form_files(file_dir, csv_file_name, closed_lots_list, inds_sorted_close_dates, dividends_list,
+                         stats=stats)
+    for export_format in export_formats:
+        with stats.stage('export'):
+            export_tax_tables(file_dir, csv_file_name,
+                              [closed_lots_list[ind_sort] for ind_sort in inds_sorted_close_dates], dividends_list,
+                              export_format=export_format)
+
+    for counter_name, value in fx_table.get_stats().items():
+        stats.count(counter_name, value)
     print('Finished generating tax forms.')
-    return
+    if profile:
+        stats.print_stats()
+    if profile_file is not None:
+        stats.save(profile_file)
+    return stats.get_stats()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run tax forms generator")
-    parser.add_argument("-dir", "--dir", type=str, required=True, help="directory path of the csv file")
-    parser.add_argument("-csv_file_name", "--csv_name", type=str, required=True, help="csv file name (without suffix)")
+    parser.add_argument("-dir", "--dir", type=str, required=False, help="directory path of the csv file")
+    parser.add_argument("-csv_file_name", "--csv_name", type=str, required=False, help="csv file name (without suffix)")
+    parser.add_argument("-input_format", "--input_format", default='csv', type=str, choices=['csv', 'xml'],
+                        help="'xml' reads an IB Flex Query xml file (named by --csv_name) instead of the csv file")
     parser.add_argument("-verbosity", "--verbosity", default=0, type=int, required=False,
                         help="verbosity of output during run")
+    parser.add_argument("-refresh_rates", "--refresh_rates", action="store_true",
+                        help="download the ECB exchange rates again instead of using the local snapshot")
+    parser.add_argument("-engine", "--engine", default='scalar', type=str, choices=['scalar', 'numpy'],
+                        help="computation engine of the closed lots, 'numpy' is faster for very large statements")
+    parser.add_argument("-export", "--export", default=[], nargs='*', type=str, choices=['csv', 'parquet'],
+                        help="also write the capital gains and dividends tables as csv and/or parquet files")
+    parser.add_argument("-batch", "--batch", type=str, required=False,
+                        help="process many csv files in parallel: a directory, a glob pattern, "
+                             "or a manifest file with one csv path per line (replaces --dir and --csv_name)")
+    parser.add_argument("-workers", "--workers", default=None, type=int, required=False,
+                        help="number of worker processes in batch mode (default: number of cpus)")
+    parser.add_argument("-batch_report", "--batch_report", default=None, type=str, required=False,
+                        help="json file to write the per-file report of the batch to")
+    parser.add_argument("-profile", "--profile", action="store_true",
+                        help="print the wall time of every stage of the run and its counters")
+    parser.add_argument("-profile_file", "--profile_file", default=None, type=str, required=False,
+                        help="json file to write the stage times and counters of the run to")
+    parser.add_argument("-max_lots_in_memory", "--max_lots_in_memory", default=None, type=int, required=False,
+                        help="stream the closed lots from the csv file to the workbook, sorting them by closing date "
+                             "with temporary files above this number of lots (for statements too large for memory, "
+                             "--export csv only, the result cache is never used)")
+    parser.add_argument("-validate", "--validate", action="store_true",
+                        help="only check the structure of the csv file (sections, row counts, date format, currencies),"
+                             " without network access and without writing the Excel file (every csv file with --batch)")
+    parser.add_argument("-no_result_cache", "--no_result_cache", action="store_true",
+                        help="compute all the closed lots and dividends again instead of reusing the results of "
+                             "previous runs of the same csv file")
     args = parser.parse_args()
-    generate_tax_forms(args.dir, args.csv_name, args.verbosity)
+    if args.batch is not None and (args.input_format != 'csv' or args.max_lots_in_memory is not None):
+        parser.error('--batch reads csv files only and keeps every statement in memory, '
+                     'it cannot be used with --input_format xml or --max_lots_in_memory')
+    elif args.batch is not None and (args.profile or args.profile_file is not None):
+        parser.error('--batch writes the stats of every statement to --batch_report, '
+                     'it cannot be used with --profile or --profile_file')
+    elif args.batch is not None:
+        from tax_forms_batch import generate_tax_forms_batch
+        generate_tax_forms_batch(args.batch, num_workers=args.workers, verbosity=args.verbosity,
+                                 refresh_rates=args.refresh_rates, engine=args.engine, export_formats=args.export,
+                                 report_file=args.batch_report, use_result_cache=not args.no_result_cache,
+                                 validate_only=args.validate)
+    elif args.dir is None or args.csv_name is None:
+        parser.error('--dir and --csv_name are required (unless --batch is used)')
+    elif args.input_format == 'xml' and (args.validate or args.max_lots_in_memory is not None):
+        parser.error('--validate and --max_lots_in_memory read csv files only')
+    elif args.max_lots_in_memory is not None and any(export_format != 'csv' for export_format in args.export):
+        parser.error('--max_lots_in_memory can only be used with --export csv')
+    elif args.validate:
+        print(json.dumps(validate_statement(args.dir + '/' + args.csv_name + '.csv'), indent=1))
+    elif args.max_lots_in_memory is not None:
+        from statement_stream import generate_tax_forms_streaming
+        generate_tax_forms_streaming(args.dir, args.csv_name, args.verbosity, refresh_rates=args.refresh_rates,
+                                     engine=args.engine, max_lots_in_memory=args.max_lots_in_memory,
+                                     export_formats=args.export, profile=args.profile, profile_file=args.profile_file)
+    else:
+        generate_tax_forms(args.dir, args.csv_name, args.verbosity, refresh_rates=args.refresh_rates,
+                           engine=args.engine, export_formats=args.export, profile=args.profile,
+                           profile_file=args.profile_file, use_result_cache=not args.no_result_cache,
+                           input_format=args.input_format)
@@ -0,0 +1,251 @@
+import argparse
+import concurrent.futures
+import datetime
+import http.server
+import json
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from aux_functions import validate_statement, RateDataError
+from cpi_israel import get_default_cpi_store
+from fx_rates import get_ecb_rate_store, refresh_ecb_rate_store
+from tax_forms_functions import generate_tax_forms
+
+SERVER_DEFAULT_HOST = '127.0.0.1'
+SERVER_DEFAULT_PORT = 8765
+SERVER_MAX_WORKERS = 4
+SERVER_MAX_UPLOAD_BYTES = 200 * 1024 ** 2
+# the ECB rates are downloaded again once a day, and the CPI of the last years is kept warm (final months are never
+# fetched again, provisional months are refetched once stale, see cpi_israel.IsraelCpiStore)
+SERVER_REFRESH_INTERVAL = 24 * 3600
+SERVER_WARM_CPI_YEARS = 5
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def get_statement_name(name):
+    # the statement name is used in file names, so only simple characters are kept
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', name or 'statement')
+    return name.lstrip('.') or 'statement'
+
+
+class TaxFormsService:
+    """
+    Keeps the FX and CPI stores of the process loaded between requests, refreshes them periodically in a background
+    thread, and generates the tax forms of uploaded statements on a bounded pool of worker threads.
+    """
+
+    def __init__(self, num_workers=SERVER_MAX_WORKERS, refresh_interval=SERVER_REFRESH_INTERVAL):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        self.num_workers = num_workers
+        self.refresh_interval = refresh_interval
+        self.last_refresh = None
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.refresh_thread = None
+
+    def warm_up(self, refresh_rates=False):
+        if refresh_rates:
+            refresh_ecb_rate_store()
+        else:
+            get_ecb_rate_store()
+        now = datetime.datetime.now()
+        get_default_cpi_store().prefetch([datetime.date(year, month, 1)
+                                          for year in range(now.year - SERVER_WARM_CPI_YEARS, now.year + 1)
+                                          for month in range(1, 13)
+                                          if (year, month) <= (now.year, now.month)])
+        self.last_refresh = now
+        return
+
+    def start(self, refresh_rates=False):
+        self.warm_up(refresh_rates=refresh_rates)
+        self.refresh_thread = threading.Thread(target=self.run_periodic_refresh, daemon=True)
+        self.refresh_thread.start()
+        return
+
+    def run_periodic_refresh(self):
+        while not self.stop_event.wait(self.refresh_interval):
+            try:
+                self.warm_up(refresh_rates=True)
+            except Exception as error:
+                # the previous rates stay in use, the refresh is tried again at the next interval
+                print('refresh of the rate data failed:', repr(error))
+        return
+
+    def stop(self):
+        self.stop_event.set()
+        self.pool.shutdown(wait=True)
+        return
+
+    def generate(self, csv_content, name=None, engine='scalar'):
+        """
+        returns the xlsx file of the statement and the stats of the run.
+        """
+        return self.pool.submit(self.generate_in_worker, csv_content, get_statement_name(name), engine).result()
+
+    def generate_in_worker(self, csv_content, csv_file_name, engine):
+        # every request works in a directory of its own, the results of uploads are not kept in the result cache
+        with tempfile.TemporaryDirectory(prefix='tax_forms_') as file_dir:
+            with open(file_dir + '/' + csv_file_name + '.csv', 'wb') as write_obj:
+                write_obj.write(csv_content)
+            stats = generate_tax_forms(file_dir, csv_file_name, engine=engine, use_result_cache=False)
+            with open(file_dir + '/tax_forms_' + csv_file_name + '.xlsx', 'rb') as read_obj:
+                xlsx_content = read_obj.read()
+        with self.lock:
+            self.num_requests += 1
+        return xlsx_content, stats
+
+    def validate(self, csv_content):
+        with tempfile.TemporaryDirectory(prefix='tax_forms_') as file_dir:
+            csv_file = file_dir + '/statement.csv'
+            with open(csv_file, 'wb') as write_obj:
+                write_obj.write(csv_content)
+            report = validate_statement(csv_file)
+        report['csv_file'] = None
+        return report
+
+    def get_health(self):
+        ecb_rate_store = get_ecb_rate_store()
+        ecb_last_date = ecb_rate_store.get_last_date()
+        return {'status': 'ok',
+                'workers': self.num_workers,
+                'requests': self.num_requests,
+                'last_refresh': self.last_refresh.isoformat() if self.last_refresh is not None else None,
+                'ecb_currencies': len(ecb_rate_store.currencies),
+                'ecb_last_date': ecb_last_date.isoformat() if ecb_last_date is not None else None,
+                'cpi_months': len(get_default_cpi_store().cpi_dict)}
+
+
+class TaxFormsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /health: the state of the service.
+    POST /generate?name=...&engine=scalar|numpy with the csv file as the body: the xlsx file of the tax forms,
+    with the stats of the run in the X-Tax-Forms-Stats header.
+    an invalid statement is answered with 400, a failure of the rate sources (CBS, ECB) with 503 and any other
+    failure with 500.
+    POST /validate with the csv file as the body: the report of aux_functions.validate_statement.
+    """
+
+    def address_string(self):
+        # the client address of a unix socket is empty
+        if isinstance(self.client_address, tuple) and len(self.client_address) > 0:
+            return str(self.client_address[0])
+        return 'unix-socket'
+
+    def send_content(self, status, content, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for header_name, header_value in (headers or {}).items():
+            self.send_header(header_name, header_value)
+        self.end_headers()
+        self.wfile.write(content)
+        return
+
+    def send_json(self, status, data):
+        self.send_content(status, json.dumps(data, indent=1).encode(), 'application/json')
+        return
+
+    def read_body(self):
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length <= 0:
+            raise ValueError('the request has no csv content')
+        if content_length > SERVER_MAX_UPLOAD_BYTES:
+            raise ValueError('the csv content is too large', content_length)
+        return self.rfile.read(content_length)
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path == '/health':
+            self.send_json(200, self.server.service.get_health())
+        else:
+            self.send_json(404, {'error': 'not found'})
+        return
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path not in ['/generate', '/validate']:
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            csv_content = self.read_body()
+            if url.path == '/validate':
+                self.send_json(200, self.server.service.validate(csv_content))
+                return
+            engine = query.get('engine', ['scalar'])[0]
+            if engine not in ['scalar', 'numpy']:
+                raise ValueError('invalid engine', engine)
+            name = get_statement_name(query.get('name', ['statement'])[0])
+            start_time = time.time()
+            xlsx_content, stats = self.server.service.generate(csv_content, name=name, engine=engine)
+            stats['request_seconds'] = time.time() - start_time
+        except RateDataError as error:
+            # the rate sources failed, not the statement: the request can be retried later
+            self.send_json(503, {'error': repr(error)})
+            return
+        except ValueError as error:
+            self.send_json(400, {'error': repr(error)})
+            return
+        except Exception as error:
+            self.send_json(500, {'error': repr(error)})
+            return
+        self.send_content(200, xlsx_content, XLSX_CONTENT_TYPE,
+                          {'Content-Disposition': 'attachment; filename="tax_forms_' + name + '.xlsx"',
+                           'X-Tax-Forms-Stats': json.dumps(stats)})
+        return
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def run_server(host=SERVER_DEFAULT_HOST, port=SERVER_DEFAULT_PORT, socket_path=None, num_workers=SERVER_MAX_WORKERS,
+               refresh_interval=SERVER_REFRESH_INTERVAL, refresh_rates=False):
+    """
+    serve the tax forms over local HTTP (host and port), or over a unix socket if socket_path is given,
+    until interrupted.
+    """
+    service = TaxFormsService(num_workers=num_workers, refresh_interval=refresh_interval)
+    service.start(refresh_rates=refresh_rates)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, TaxFormsRequestHandler)
+        print('Serving tax forms on unix socket ' + socket_path)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), TaxFormsRequestHandler)
+        print('Serving tax forms on http://' + host + ':' + str(server.server_address[1]))
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the tax forms generator over a local HTTP or unix socket API")
+    parser.add_argument("-host", "--host", default=SERVER_DEFAULT_HOST, type=str, help="host to listen on")
+    parser.add_argument("-port", "--port", default=SERVER_DEFAULT_PORT, type=int, help="port to listen on")
+    parser.add_argument("-socket", "--socket", default=None, type=str, required=False,
+                        help="path of a unix socket to listen on instead of host and port")
+    parser.add_argument("-workers", "--workers", default=SERVER_MAX_WORKERS, type=int,
+                        help="number of statements processed concurrently")
+    parser.add_argument("-refresh_interval", "--refresh_interval", default=SERVER_REFRESH_INTERVAL, type=int,
+                        help="seconds between refreshes of the ECB rates and the CPI values")
+    parser.add_argument("-refresh_rates", "--refresh_rates", action="store_true",
+                        help="download the ECB exchange rates again at startup instead of using the local snapshot")
+    args = parser.parse_args()
+    run_server(host=args.host, port=args.port, socket_path=args.socket, num_workers=args.workers,
+               refresh_interval=args.refresh_interval, refresh_rates=args.refresh_rates)